@@ -0,0 +1,214 @@
+import os
+import csv
+import sys
+import json
+import argparse
+
+import LockStore
+from LockBotBrain import (LockDB, Lock, DBNAME, NAME, POOLPREFIX, POOLNAME, SELECTOR,
+                          splitattrs, joinattrs)
+
+FIELDS = ('resource', 'owner', 'expires', 'ttl', 'pools', 'waiters')
+
+# waiter fields and the attributes they are written as in CSV files
+WAITFIELDS = (('priority', 'pri'), ('queued', 't'), ('ttl', 'ttl'), ('group', 'all'))
+
+def tostr(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def opendb(dbdir, storage, create=False):
+    if create and not os.path.isdir(dbdir):
+        os.mkdir(dbdir)
+    if not os.path.isdir(dbdir):
+        raise IOError('no database directory %s' % dbdir)
+    return LockDB(LockStore.openstore(storage, os.path.join(dbdir, DBNAME)))
+
+class Detached(object):
+    # stands in for the LockDB while a Lock is only looked at, so that
+    # building it marks nothing to be written back
+    def touch(self, name):
+        pass
+
+DETACHED = Detached()
+
+def fromlock(lock):
+    waiters = []
+    for nick in lock.waiters:
+        waiter = {'nick': nick}
+        for (field, _), value in zip(WAITFIELDS, lock.waitrequest(nick)):
+            if value:
+                waiter[field] = value
+        waiters.append(waiter)
+    return {'resource': lock.name, 'owner': lock.owner, 'expires': lock.expires,
+            'ttl': lock.ttl, 'pools': list(lock.pools), 'waiters': waiters}
+
+def tocsv(waiter):
+    return joinattrs(waiter['nick'], dict((attr, waiter.get(field))
+                                          for field, attr in WAITFIELDS))
+
+def fromcsv(text):
+    nick, attrs = splitattrs(text)
+    waiter = {'nick': nick}
+    for field, attr in WAITFIELDS:
+        if attr in attrs:
+            waiter[field] = attrs[attr]
+    return waiter
+
+def readrecords(f, fileformat):
+    """yield (record, line number) from a JSON lines or CSV file"""
+    if fileformat == 'csv':
+        reader = csv.DictReader(f)
+        for row in reader:
+            row = dict((k, v or '') for k, v in row.items())
+            row['pools'] = row.get('pools', '').split()
+            row['waiters'] = [fromcsv(w) for w in row.get('waiters', '').split()]
+            yield row, reader.line_num
+        return
+    for number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line), number
+        except ValueError as exc:
+            raise ValueError('line %d: %s' % (number, exc))
+
+def towaiter(waiter):
+    # plain nicks are what exports held before waiters had fields
+    if not isinstance(waiter, dict):
+        waiter = {'nick': waiter}
+    return (tostr(waiter.get('nick') or ''), int(waiter.get('priority') or 0),
+            int(waiter.get('queued') or 0), int(waiter.get('ttl') or 0),
+            waiter.get('group') and tostr(waiter['group']))
+
+def tolock(record):
+    """the Lock described by record, detached from any LockDB; raises
+    ValueError if the record is malformed"""
+    if not isinstance(record, dict):
+        raise ValueError('records must be objects')
+    name = tostr(record.get('resource') or '')
+    if not NAME.match(name) or name.startswith(POOLPREFIX) or SELECTOR.search(name):
+        raise ValueError('invalid resource name "%s"' % name)
+    owner = tostr(record.get('owner') or '')
+    requests = [towaiter(w) for w in record.get('waiters') or []]
+    waiters = [nick for nick, _, _, _, _ in requests]
+    for nick in ([owner] if owner else []) + waiters:
+        if not NAME.match(nick):
+            raise ValueError('invalid nick "%s" on %s' % (nick, name))
+    # only all-or-nothing requests wait on free resources, for the others
+    # of their group
+    if not owner and [nick for nick, _, _, _, group in requests if not group]:
+        raise ValueError('%s has waiters but no owner' % name)
+    if owner in waiters or len(set(waiters)) != len(waiters):
+        raise ValueError('%s queues a nick twice' % name)
+    pools = [tostr(p) for p in record.get('pools') or []]
+    for pool in pools:
+        if not POOLNAME.match(pool):
+            raise ValueError('invalid pool name "%s" on %s' % (pool, name))
+
+    lock = Lock(DETACHED, name)
+    lock.owner = owner
+    lock.lease(int(record.get('ttl') or 0), int(record.get('expires') or 0))
+    for pool in pools:
+        lock.tag(pool)
+    for nick, priority, queued, ttl, group in requests:
+        lock.wait(nick, ttl, group, priority, queued)
+    return lock
+
+def export(db, f, fileformat):
+    if fileformat == 'csv':
+        writer = csv.writer(f)
+        writer.writerow(FIELDS)
+    for name in sorted(db):
+        # built for the record only, so the table is never held all at once
+        record = fromlock(Lock(DETACHED, name, db.entry(name)))
+        if fileformat == 'csv':
+            record['pools'] = ' '.join(record['pools'])
+            record['waiters'] = ' '.join(tocsv(w) for w in record['waiters'])
+            writer.writerow([record[k] for k in FIELDS])
+        else:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+def load(db, records, replace=False):
+    """stage the locks read from records in db, returns how many resources
+    were (added, changed, removed); nothing is committed"""
+    added = changed = removed = 0
+    seen = set()
+    for record, number in records:
+        try:
+            lock = tolock(record)
+        except (ValueError, TypeError) as exc:
+            raise ValueError('line %d: %s' % (number, exc))
+        if lock.name in seen:
+            raise ValueError('line %d: %s is listed twice' % (number, lock.name))
+        seen.add(lock.name)
+        if lock.name not in db:
+            added += 1
+        elif fromlock(Lock(DETACHED, lock.name, db.entry(lock.name))) != fromlock(lock):
+            changed += 1
+        else:
+            continue
+        lock.db = db
+        db[lock.name] = lock
+    if replace:
+        for name in [name for name in db if name not in seen]:
+            del db[name]
+            removed += 1
+    return added, changed, removed
+
+def guessformat(path, fileformat):
+    if fileformat:
+        return fileformat
+    return 'csv' if path and path.endswith('.csv') else 'json'
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description='bulk import and export of a lockbot database; '
+                    'the bot has to be stopped while this runs')
+    parser.add_argument('command', choices=('export', 'import'))
+    parser.add_argument('dbdir', help="the bot's dbdir, or dbdir/<channel> "
+                                      "for a channel other than the first, with "
+                                      "characters other than a-z0-9_- %%-encoded")
+    parser.add_argument('file', nargs='?', default='-',
+                        help='file to read or write, - for stdin/stdout')
+    parser.add_argument('--format', choices=('json', 'csv'),
+                        help='JSON lines or CSV (default: by file extension, else json)')
+    parser.add_argument('--storage', default='log', choices=sorted(LockStore.STORES))
+    parser.add_argument('--replace', action='store_true',
+                        help='unregister resources missing from the import')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only report what an import would change')
+    options = parser.parse_args(args)
+    fileformat = guessformat(options.file, options.format)
+
+    try:
+        db = opendb(options.dbdir, options.storage, create=options.command == 'import')
+    except IOError as exc:
+        sys.stderr.write('%s\n' % exc)
+        return 1
+    try:
+        if options.command == 'export':
+            f = sys.stdout if options.file == '-' else open(options.file, 'wb')
+            export(db, f, fileformat)
+            if f is not sys.stdout:
+                f.close()
+            return 0
+
+        f = sys.stdin if options.file == '-' else open(options.file, 'rb')
+        try:
+            added, changed, removed = load(db, readrecords(f, fileformat), options.replace)
+        except ValueError as exc:
+            sys.stderr.write('import failed, nothing changed: %s\n' % exc)
+            return 1
+        if not options.dry_run:
+            # all of it goes to the store as one batch
+            db.commit()
+        sys.stdout.write('%s%d added, %d changed, %d removed\n' %
+                         ('dry run: ' if options.dry_run else '', added, changed, removed))
+        return 0
+    finally:
+        db.store.close()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
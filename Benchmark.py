@@ -0,0 +1,335 @@
+import gc
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+
+import LockStore
+from LockBotBrain import LockDB, LockBotBrain
+
+def dirsize(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+def timeit(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return time.time() - start, result
+
+def benchstorage(kind, resources=10000, commands=2000):
+    tmpdir = tempfile.mkdtemp(prefix='lockbot-bench-')
+    path = os.path.join(tmpdir, 'locks')
+    try:
+        db = LockDB(LockStore.openstore(kind, path))
+        names = ['host%05d' % i for i in range(resources)]
+
+        def register():
+            for name in names:
+                db.add(name)
+            db.commit()
+
+        def churn():
+            for i in range(commands):
+                lock = db[names[i % resources]]
+                lock.owner = 'user%d' % (i % 7) if not lock.owner else ''
+                db.commit()
+
+        tregister, _ = timeit(register)
+        tchurn, _ = timeit(churn)
+        db.store.close()
+        topen, db = timeit(lambda: LockDB(LockStore.openstore(kind, path)))
+        assert len(db) == resources
+        db.store.close()
+
+        return [('register %d' % resources, '%.3fs' % tregister),
+                ('%d lock/unlock commits' % commands,
+                 '%.1f commits/s' % (commands / tchurn)),
+                ('reopen', '%.3fs' % topen),
+                ('bytes on disk', '%d' % dirsize(tmpdir))]
+    finally:
+        shutil.rmtree(tmpdir)
+
+def rss():
+    """resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except IOError:
+        # peak rather than current size, good enough while only growing
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def benchmemory(resources=10000):
+    tmpdir = tempfile.mkdtemp(prefix='lockbot-bench-')
+    path = os.path.join(tmpdir, 'locks')
+    try:
+        # every 7th resource locked, every 50th with a waiter as well
+        store = LockStore.openstore('log', path)
+        store.commit(('host%07d' % i,
+                      'ci%02d' % (i % 40) + (',ci%02d' % (i % 39) if i % 50 == 0 else '')
+                      if i % 7 == 0 else '')
+                     for i in range(resources))
+        store.close()
+
+        gc.collect()
+        before = rss()
+        db = LockDB(LockStore.openstore('log', path))
+        loaded = rss()
+        for name in db:
+            db[name]
+        used = rss()
+        db.store.close()
+
+        return [('loaded', '%d bytes/resource' % ((loaded - before) / resources)),
+                ('every lock in use', '%d bytes/resource' % ((used - before) / resources))]
+    finally:
+        shutil.rmtree(tmpdir)
+
+CHATTER = [
+    "anyone know why the nightly is red again?",
+    "lunch in 10",
+    "I think the lockbot config lives on the build host",
+    "  brb",
+    "lol",
+    "deploying the unlocked build to staging now",
+]
+
+COMMANDS = [
+    "lock host00042",
+    "unlock(host00042)",
+    "trylock host00007,host00008",
+    "lockbot: status",
+    "lockbot: assignlock bob host00001",
+    "lockbot: listfree",
+    "lockbot: what is this",
+]
+
+def legacymatch(brain, msg):
+    # the rule loop processPrivMsg ran before the rules were compiled
+    for regexp, handler in brain.rules:
+        m = re.match(regexp, msg)
+        if m:
+            return handler, m.groups()
+    return None, ()
+
+def benchdispatch(rounds=20000):
+    tmpdir = tempfile.mkdtemp(prefix='lockbot-bench-')
+    try:
+        brain = LockBotBrain('lockbot', tmpdir)
+        rows = []
+        for traffic, msgs in (('chatter', CHATTER), ('commands', COMMANDS)):
+            for msg in msgs:
+                assert legacymatch(brain, msg) == brain.matchRule(msg), msg
+            for label, match in (('rule loop', legacymatch),
+                                 ('compiled', lambda b, m: b.matchRule(m))):
+                def run():
+                    for i in range(rounds):
+                        match(brain, msgs[i % len(msgs)])
+                elapsed, _ = timeit(run)
+                rows.append(('%s, %s' % (traffic, label),
+                             '%.0f msgs/s' % (rounds / elapsed)))
+        return rows
+    finally:
+        shutil.rmtree(tmpdir)
+
+# default weights of the kinds of traffic in a synthetic transcript
+MIX = {'chatter': 50, 'lock': 25, 'multi': 8, 'typo': 12, 'status': 5}
+
+NICKS = ['ci%02d' % i for i in range(40)] + ['alice', 'bob', 'carol', 'dave']
+
+def typo(name, rng):
+    i = rng.randrange(len(name))
+    if rng.random() < 0.5:
+        return name[:i] + name[i + 1:]
+    return name[:i] + rng.choice('abcdefghijklmnopqrstuvwxyz0123456789') + name[i + 1:]
+
+def synthetic(names, messages, mix=MIX, seed=1):
+    """yield (kind, nick, msg) for a made up channel transcript"""
+    rng = random.Random(seed)
+    kinds = sorted(mix)
+    weights = [mix[k] for k in kinds]
+    held = dict((nick, []) for nick in NICKS)
+    for _ in range(messages):
+        kind = kinds[pick(weights, rng.random() * sum(weights))]
+        nick = rng.choice(NICKS)
+        if kind == 'chatter':
+            msg = rng.choice(CHATTER)
+        elif kind == 'lock':
+            if held[nick] and rng.random() < 0.5:
+                msg = 'unlock %s' % held[nick].pop(rng.randrange(len(held[nick])))
+            else:
+                name = rng.choice(names)
+                held[nick].append(name)
+                msg = 'trylock %s' % name
+        elif kind == 'multi':
+            batch = rng.sample(names, 3)
+            if rng.random() < 0.5:
+                msg = 'lock %s' % ','.join(batch)
+                held[nick].extend(batch)
+            else:
+                msg = 'trylock(%s)' % ','.join(batch)
+        elif kind == 'typo':
+            msg = 'trylock %s' % typo(rng.choice(names), rng)
+        else:
+            msg = 'lockbot: %s' % rng.choice(['status', 'listfree', 'list'])
+        yield kind, nick, msg
+
+def pick(weights, x):
+    for i, w in enumerate(weights):
+        x -= w
+        if x < 0:
+            return i
+    return len(weights) - 1
+
+TRANSCRIPTLINE = re.compile(r'^(?:\[[^]]*\]\s*)?<?([^\s>]+)>?\s+(.*)$')
+
+def transcript(path):
+    """yield (kind, nick, msg) from an IRC log, one "<nick> message" per line"""
+    with open(path) as f:
+        for line in f:
+            m = TRANSCRIPTLINE.match(line.rstrip('\n'))
+            if m:
+                yield 'recorded', m.group(1), m.group(2)
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def benchreplay(lines, resources=10000, storage='log'):
+    """run lines through processPrivMsg, returns (rows, results)"""
+    tmpdir = tempfile.mkdtemp(prefix='lockbot-bench-')
+    try:
+        brain = LockBotBrain('lockbot', tmpdir, storage)
+        names = ['host%05d' % i for i in range(resources)]
+        for i in range(0, resources, 1000):
+            brain.run(brain.register, 'bench', '#bench', ','.join(names[i:i + 1000]))
+
+        written = [0]
+        commit = brain.locks.store.commit
+        def counting(changes):
+            written[0] += sum(len(name) + len(value or '') for name, value in changes)
+            commit(changes)
+        brain.locks.store.commit = counting
+
+        latencies = {}
+        start = time.time()
+        for kind, nick, msg in lines:
+            t = time.time()
+            brain.processPrivMsg(nick + '!bench@localhost', '#bench', msg)
+            latencies.setdefault(kind, []).append(time.time() - t)
+        elapsed = time.time() - start
+        brain.close()
+
+        everything = sorted(sum(latencies.values(), []))
+        results = {'ops': len(everything) / elapsed,
+                   'p50': percentile(everything, 0.5),
+                   'p99': percentile(everything, 0.99),
+                   'bytes': written[0]}
+        rows = [('%d messages' % len(everything), '%.0f ops/s' % results['ops']),
+                ('latency p50/p99', '%.3fms / %.3fms' % (results['p50'] * 1000,
+                                                        results['p99'] * 1000))]
+        for kind in sorted(latencies):
+            values = sorted(latencies[kind])
+            rows.append(('  %s (%d)' % (kind, len(values)),
+                         '%.3fms / %.3fms' % (percentile(values, 0.5) * 1000,
+                                              percentile(values, 0.99) * 1000)))
+        rows.append(('bytes committed', '%d' % results['bytes']))
+        rows.append(('bytes on disk', '%d' % dirsize(tmpdir)))
+        return rows, results
+    finally:
+        shutil.rmtree(tmpdir)
+
+def regressions(results, baseline, tolerance):
+    """what got worse than baseline by more than tolerance"""
+    failed = []
+    if results['ops'] < baseline['ops'] * (1 - tolerance):
+        failed.append('ops/s %.0f < %.0f' % (results['ops'], baseline['ops']))
+    for key in ('p50', 'p99'):
+        if results[key] > baseline[key] * (1 + tolerance):
+            failed.append('%s %.3fms > %.3fms' % (key, results[key] * 1000,
+                                                  baseline[key] * 1000))
+    if results['bytes'] > baseline['bytes'] * (1 + tolerance):
+        failed.append('bytes committed %d > %d' % (results['bytes'], baseline['bytes']))
+    return failed
+
+def replay(options):
+    if options.transcript:
+        lines = list(transcript(options.transcript))
+        key = 'replay %s' % os.path.basename(options.transcript)
+    else:
+        names = ['host%05d' % i for i in range(options.resources)]
+        lines = list(synthetic(names, options.messages, seed=options.seed))
+        key = 'replay %d messages' % options.messages
+    key += ', %d resources, %s' % (options.resources, options.storage)
+
+    rows, results = benchreplay(lines, options.resources, options.storage)
+    report(key, rows)
+    if not options.baseline:
+        return 0
+
+    baselines = {}
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as f:
+            baselines = json.load(f)
+    if options.save_baseline:
+        baselines[key] = results
+        with open(options.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        sys.stdout.write('saved baseline to %s\n' % options.baseline)
+        return 0
+    if key not in baselines:
+        sys.stderr.write('no baseline for "%s" in %s\n' % (key, options.baseline))
+        return 1
+    failed = regressions(results, baselines[key], options.tolerance)
+    for failure in failed:
+        sys.stderr.write('REGRESSION: %s\n' % failure)
+    return 1 if failed else 0
+
+def report(title, rows):
+    sys.stdout.write('%s\n' % title)
+    for name, value in rows:
+        sys.stdout.write('  %-28s %s\n' % (name, value))
+
+def main(args):
+    parser = argparse.ArgumentParser(description='lockbot benchmarks')
+    parser.add_argument('benchmarks', nargs='*')
+    parser.add_argument('--resources', type=int, default=10000,
+                        help='resources registered for replay and memory')
+    parser.add_argument('--messages', type=int, default=20000,
+                        help='length of the synthetic transcript')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--transcript', help='replay this IRC log instead')
+    parser.add_argument('--storage', default='log', choices=sorted(LockStore.STORES))
+    parser.add_argument('--baseline', help='JSON file with replay baselines')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='record the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown against the baseline (default 0.2)')
+    options = parser.parse_args(args)
+
+    def storage():
+        for kind in sorted(LockStore.STORES):
+            report('storage: %s' % kind, benchstorage(kind))
+
+    benchmarks = {
+        'dispatch': lambda: report('dispatch', benchdispatch()),
+        'memory': lambda: report('memory, %d resources' % options.resources,
+                                 benchmemory(options.resources)),
+        'storage': storage,
+        'replay': lambda: replay(options),
+    }
+    names = options.benchmarks or sorted(benchmarks)
+    status = 0
+    for name in names:
+        if name not in benchmarks:
+            sys.stderr.write("unknown benchmark %s (expected one of %s)\n" %
+                             (name, ', '.join(sorted(benchmarks))))
+            return 1
+        status = benchmarks[name]() or status
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,233 @@
+import os
+from bisect import bisect_left
+
+# Hold and wait durations are counted in buckets growing by 25%, so
+# percentiles come out within a quarter of the true value whatever the
+# length of the journal; the first bucket is for no wait at all.
+BUCKETS = [0] + [1.25 ** i for i in range(75)]
+
+# kinds of event ending a hold
+RELEASES = ('release', 'free', 'expire')
+
+def human(seconds):
+    if seconds < 60:
+        return '%ds' % seconds
+    if seconds < 3600:
+        return '%dm' % (seconds / 60)
+    if seconds < 86400:
+        return '%.1fh' % (seconds / 3600.0)
+    return '%.1fd' % (seconds / 86400.0)
+
+class Journal(object):
+    """rotating append-only log of lock events
+
+    Every event is one line, "<time> <kind> <resource> <nick> <seconds
+    waited> <pools>", with '-' standing for an empty field. Kinds are
+    grant, wait, release, free (freelock) and expire (lease ran out).
+    A journal created at time now starts with a "start" line, so the
+    quiet time before its first lock event counts as idle. Once <path>
+    outgrows maxbytes it becomes <path>.1, older files move up to
+    <path>.<keep> and the oldest is dropped. Every new file starts with
+    a "held" line for each resource locked at that time, as listed by
+    checkpoint(), so each file can be read without the ones before it.
+    """
+    def __init__(self, path, checkpoint=list, maxbytes=8 * 1024 * 1024, keep=8, now=None):
+        self.path = path
+        self.checkpoint = checkpoint
+        self.maxbytes = maxbytes
+        self.keep = keep
+        self.f = open(path, 'ab')
+        # append mode only moves to the end on the first write
+        self.f.seek(0, os.SEEK_END)
+        if now is not None and self.f.tell() == 0:
+            self.write(now, 'start', '-', '', 0, ())
+
+    def record(self, when, kind, resource, nick, waited=0, pools=()):
+        if self.f.tell() >= self.maxbytes:
+            self.rotate(when)
+        self.write(when, kind, resource, nick, waited, pools)
+
+    def write(self, when, kind, resource, nick, waited, pools):
+        self.f.write('%.3f %s %s %s %s %s\n' % (when, kind, resource, nick or '-',
+                                                '%.3f' % waited if waited else '-',
+                                                '+'.join(pools) or '-'))
+
+    def rotate(self, when):
+        self.f.close()
+        for i in range(self.keep - 1, 0, -1):
+            if os.path.exists('%s.%d' % (self.path, i)):
+                os.rename('%s.%d' % (self.path, i), '%s.%d' % (self.path, i + 1))
+        os.rename(self.path, self.path + '.1')
+        self.f = open(self.path, 'ab')
+        for resource, nick, pools in self.checkpoint():
+            self.write(when, 'held', resource, nick, 0, pools)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+def parse(line):
+    fields = line.split()
+    if len(fields) != 6:
+        return None
+    when, kind, resource, nick, waited, pools = fields
+    try:
+        return (float(when), kind, resource, '' if nick == '-' else nick,
+                0.0 if waited == '-' else float(waited),
+                () if pools == '-' else tuple(pools.split('+')))
+    except ValueError:
+        return None
+
+def files(path, since=None, maxbytes=None):
+    """the journal files holding events from since on, oldest first,
+    with the offset to start reading each at: reading stops maxbytes
+    short of the end of the journal"""
+    found = []
+    left = maxbytes
+    for name in [path] + ['%s.%d' % (path, i) for i in range(1, 1000)]:
+        if not os.path.exists(name):
+            if name != path:
+                break
+            continue
+        if left is not None:
+            size = os.path.getsize(name)
+            if size >= left:
+                found.append((name, size - left))
+                break
+            left -= size
+        found.append((name, 0))
+        if since is not None:
+            with open(name, 'rb') as f:
+                first = parse(f.readline())
+            # this file's checkpoint already covers the time before it
+            if first and first[0] <= since:
+                break
+    return found[::-1]
+
+def readevents(path, since=None, maxbytes=None):
+    """stream the events of the journal at path, oldest first, from at
+    most its last maxbytes; a torn or garbled line is skipped"""
+    for name, offset in files(path, since, maxbytes):
+        with open(name, 'rb') as f:
+            if offset:
+                # start at the first whole line
+                f.seek(offset - 1)
+                f.readline()
+            for line in f:
+                event = parse(line)
+                if event:
+                    yield event
+
+class Summary(object):
+    """count and bucketed distribution of durations"""
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+
+    def percentile(self, p):
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen > p * self.count:
+                return BUCKETS[min(i, len(BUCKETS) - 1)]
+        return 0
+
+class Stats(object):
+    def __init__(self):
+        self.members = set()
+        self.busy = 0.0
+        self.grants = 0
+        self.waits = 0
+        self.waited = 0
+        self.holds = Summary()
+        self.waittimes = Summary()
+
+def analyze(events, start, end, keys=None):
+    """Stats per resource and per pool:<name> over the window start..end
+
+    keys limits the result to those resources and pools. Only the holds
+    still open are kept while the events stream by. Also returns the time
+    of the first event, a "start" line if the journal was read from its
+    beginning, as nothing is known from before it: a resource released
+    without being seen taken was held since then.
+    """
+    stats = {}
+    # resource -> (held since, whether that is when it was granted, pools)
+    opened = {}
+    first = None
+    def statsof(resource, pools):
+        for key in ([resource] if resource else []) + ['pool:' + p for p in pools]:
+            if keys is None or key in keys:
+                if key not in stats:
+                    stats[key] = Stats()
+                if resource:
+                    stats[key].members.add(resource)
+                yield stats[key]
+
+    def close(resource, until, ended=True):
+        since, known, pools = opened.pop(resource)
+        overlap = min(until, end) - max(since, start)
+        for s in statsof(resource, pools):
+            if overlap > 0:
+                s.busy += overlap
+            if known and ended and start <= until <= end:
+                s.holds.observe(until - since)
+
+    for when, kind, resource, nick, waited, pools in events:
+        if first is None:
+            first = when
+        if when > end:
+            break
+        if kind == 'held':
+            if resource not in opened:
+                opened[resource] = (when, False, pools)
+        elif kind == 'grant':
+            if resource in opened:
+                close(resource, when)
+            opened[resource] = (when, True, pools)
+            for s in statsof(resource, pools):
+                if when >= start:
+                    s.grants += 1
+                    s.waittimes.observe(waited)
+                    if waited:
+                        s.waited += 1
+        elif kind in RELEASES:
+            if resource not in opened:
+                opened[resource] = (first, False, pools)
+            close(resource, when)
+        elif kind == 'wait' and when >= start:
+            # a pool request waits on the pool itself, resource "pool:<name>"
+            if resource.startswith('pool:'):
+                pools, resource = (resource[len('pool:'):],), None
+            for s in statsof(resource, pools):
+                s.waits += 1
+    for resource in list(opened):
+        # still held, busy until the end but of no known duration
+        close(resource, end, ended=False)
+    return stats, first
+
+def describe(key, stats, span, members=None):
+    """one line summary of the Stats of key over span seconds"""
+    members = members or len(stats.members) or 1
+    msg = '%s over %s: in use %d%%' % (key, human(span),
+                                       100 * stats.busy / (span * members) if span > 0 else 0)
+    if members > 1:
+        msg += ' of %d members' % members
+    msg += ', %d grant%s' % (stats.grants, '' if stats.grants == 1 else 's')
+    if stats.holds.count:
+        msg += ', held p50 %s p90 %s' % (human(stats.holds.percentile(0.5)),
+                                         human(stats.holds.percentile(0.9)))
+    if stats.waited:
+        msg += ', %d queued, wait p50 %s p90 %s p99 %s' % (stats.waited,
+                                                           human(stats.waittimes.percentile(0.5)),
+                                                           human(stats.waittimes.percentile(0.9)),
+                                                           human(stats.waittimes.percentile(0.99)))
+    if stats.waits > stats.waited:
+        msg += ', %d still waiting or gave up' % (stats.waits - stats.waited)
+    return msg
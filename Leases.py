@@ -0,0 +1,65 @@
+import re
+import heapq
+
+DURATIONS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+DURATION = re.compile(r'^(\d+)\s*([smhd])$')
+
+def parseduration(text):
+    m = DURATION.match(text.strip())
+    if not m:
+        return None
+    return int(m.group(1)) * DURATIONS[m.group(2)]
+
+def formatduration(seconds):
+    for unit in 'dhm':
+        if seconds >= DURATIONS[unit] and seconds % DURATIONS[unit] == 0:
+            return '%d%s' % (seconds / DURATIONS[unit], unit)
+    return '%ds' % seconds
+
+class LeaseTimer(object):
+    """expiry scheduler for lock leases
+
+    Expiry times sit in a heap and a single reactor timer is armed for the
+    earliest one, so thousands of leases cost no polling. Renewing a lease
+    just schedules it again; expire is called with the expiry time that
+    was scheduled and has to ignore entries that are no longer current.
+    """
+    def __init__(self, clock, expire):
+        self.clock = clock
+        self.expire = expire
+        self.heap = []
+        self.call = None
+
+    def schedule(self, name, expires):
+        heapq.heappush(self.heap, (expires, name))
+        self.arm()
+
+    def arm(self):
+        if not self.heap:
+            return
+        when = self.heap[0][0]
+        if self.call is not None:
+            if self.call.getTime() <= when:
+                return
+            self.call.cancel()
+        self.call = self.clock.callLater(max(0, when - self.clock.seconds()),
+                                         self.fire)
+
+    def fire(self):
+        self.call = None
+        now = self.clock.seconds()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            due.append(heapq.heappop(self.heap))
+        for expires, name in due:
+            self.expire(name, expires)
+        self.arm()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def stop(self):
+        if self.call is not None:
+            self.call.cancel()
+            self.call = None
@@ -0,0 +1,217 @@
+import json
+
+from twisted.internet import defer, protocol
+from twisted.protocols import basic
+
+from LockBotBrain import LockBotException, POOLREQUEST, NAME
+import Logger
+
+# op -> (brain handler, request fields passed as its arguments)
+OPS = {
+    'lock':       ('lock',       ('resources',)),
+    'waitlock':   ('waitlock',   ('resources',)),
+    'unlock':     ('unlock',     ('resources',)),
+    'assignlock': ('assignlock', ('assignee', 'resources')),
+    'freelock':   ('freelock',   ('resources',)),
+    'status':     ('status',     ()),
+    'watch':      ('subscribe',   ('resources',)),
+    'unwatch':    ('unsubscribe', ('resources',)),
+}
+
+EVENTFIELDS = ('event', 'resource', 'owner', 'previous')
+
+def tostr(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+class BlockedWait(object):
+    def __init__(self, client, brain, user, resources):
+        self.client = client
+        self.brain = brain
+        self.user = user
+        self.resources = resources
+        self.deferred = defer.Deferred()
+
+class APIWatcher(object):
+    """watch subscriber pushing events to one API connection"""
+    def __init__(self, client, namespace):
+        self.client = client
+        self.namespace = namespace
+
+    def __call__(self, events):
+        for event in events:
+            self.client.reply(dict(zip(EVENTFIELDS, event), namespace=self.namespace))
+
+class LockAPIProtocol(basic.LineReceiver):
+    """newline-delimited JSON front end to the lock brain
+
+    Each line holds one request object, or a list of them answered by a
+    list in the same order, e.g.
+
+      {"id": 1, "op": "waitlock", "user": "ci-7", "resources": "a,b",
+       "block": true, "namespace": "#lab"}
+
+    Requests without a namespace go to the bot's first channel. A blocking
+    waitlock is only answered once the user holds every requested resource.
+    After a watch request, changes of the watched resources or pools are
+    pushed as lines without an id, e.g.
+
+      {"event": "released", "resource": "a", "owner": "", "previous": "ci-7",
+       "namespace": "#lab"}
+    """
+    delimiter = '\n'
+
+    def connectionMade(self):
+        # brain -> APIWatcher of this connection
+        self.watchers = {}
+        # BlockedWaits of this connection
+        self.blocked = set()
+
+    def connectionLost(self, reason):
+        for brain, watcher in self.watchers.items():
+            brain.watchers.drop(watcher)
+        self.watchers.clear()
+        # nobody is left to use or release what these would be granted
+        for wait in list(self.blocked):
+            self.factory.giveup(wait)
+
+    def lineReceived(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError as exc:
+            self.reply({'ok': False, 'error': 'malformed request: %s' % exc})
+            return
+
+        if isinstance(request, list):
+            d = defer.gatherResults([self.factory.handle(r, self) for r in request])
+        else:
+            d = self.factory.handle(request, self)
+        d.addCallback(self.reply)
+
+    def reply(self, response):
+        if self.transport.connected:
+            self.sendLine(json.dumps(response))
+
+class LockAPIFactory(protocol.ServerFactory):
+    protocol = LockAPIProtocol
+
+    def __init__(self, brains):
+        self.brains = brains
+        # (brain, resource) -> blocked waits
+        self.blocked = {}
+        self.logger = Logger.Logger()
+        brains.commitlisteners.append(self.committed)
+
+    def handle(self, request, client):
+        if not isinstance(request, dict):
+            return defer.succeed({'ok': False, 'error': 'requests must be objects'})
+        response = {'id': request.get('id')}
+
+        op = request.get('op')
+        if op not in OPS:
+            response.update(ok=False, error='unknown op "%s"' % op)
+            return defer.succeed(response)
+        name, fields = OPS[op]
+        try:
+            user = tostr(request['user'])
+            args = [tostr(request[f]) for f in fields]
+        except KeyError as exc:
+            response.update(ok=False, error='missing field %s' % exc)
+            return defer.succeed(response)
+        for nick in [user] + ([args[0]] if 'assignee' in fields else []):
+            if not NAME.match(nick):
+                response.update(ok=False, error='invalid nick "%s"' % nick)
+                return defer.succeed(response)
+        try:
+            brain = self.brains.get(request.get('namespace') and
+                                    tostr(request['namespace']))
+        except KeyError as exc:
+            response.update(ok=False, error=exc.args[0])
+            return defer.succeed(response)
+
+        if (op == 'waitlock' and request.get('block') and
+                POOLREQUEST.match(brain.splitOptions(args[0])[0])):
+            response.update(ok=False, error='blocking waits are not supported for pools')
+            return defer.succeed(response)
+
+        self.logger.debug("api: %s %s %s", user, op, ' '.join(args))
+        try:
+            # before running, so a wait is never queued for a request
+            # answered with an error
+            if op == 'waitlock' and request.get('block'):
+                resources, _ = brain.getlocks(brain.splitOptions(args[0])[0])
+            if op in ('watch', 'unwatch'):
+                # events go to the connection rather than to the user's nick
+                if brain not in client.watchers:
+                    client.watchers[brain] = APIWatcher(
+                        client, request.get('namespace') or self.brains.primary)
+                messages = [getattr(brain, name)(user, client.watchers[brain], *args)]
+            else:
+                messages = [msg for _, msg in
+                            brain.run(getattr(brain, name), user, user, *args)]
+        except LockBotException as exc:
+            response.update(ok=False, error=exc.msg)
+            return defer.succeed(response)
+
+        response.update(ok=True, messages=messages)
+        if op != 'waitlock' or not request.get('block'):
+            return defer.succeed(response)
+
+        wait = BlockedWait(client, brain, user, resources)
+        wait.deferred.addCallback(lambda result: dict(response, **result))
+        for r in resources:
+            self.blocked.setdefault((brain, r), []).append(wait)
+        client.blocked.add(wait)
+        brain.pinned += 1
+        self.check(wait)
+        return wait.deferred
+
+    def committed(self, channel, brain, changes):
+        waits = []
+        for name, _ in changes:
+            for wait in self.blocked.get((brain, name), ()):
+                if wait not in waits:
+                    waits.append(wait)
+        for wait in waits:
+            self.check(wait)
+
+    def check(self, wait):
+        locks = wait.brain.locks
+        result = {'ok': True, 'granted': wait.resources}
+        for r in wait.resources:
+            if r not in locks:
+                result = {'ok': False, 'error': 'resource %s was unregistered' % r}
+                break
+            if locks[r].owner == wait.user:
+                continue
+            if locks[r].haswaiter(wait.user):
+                return
+            result = {'ok': False, 'error': 'no longer waiting for %s' % r}
+            break
+
+        self.unblock(wait)
+        wait.deferred.callback(result)
+
+    def unblock(self, wait):
+        for r in wait.resources:
+            key = (wait.brain, r)
+            self.blocked[key].remove(wait)
+            if not self.blocked[key]:
+                del self.blocked[key]
+        wait.client.blocked.discard(wait)
+        wait.brain.pinned -= 1
+
+    def giveup(self, wait):
+        """leave the queues a blocked wait is still in"""
+        self.unblock(wait)
+        locks = wait.brain.locks
+        waiting = [r for r in wait.resources if r in locks and locks[r].haswaiter(wait.user)]
+        if not waiting:
+            return
+        self.logger.info("api: %s disconnected, no longer waiting for %s",
+                         wait.user, ', '.join(waiting))
+        try:
+            wait.brain.run(wait.brain.unlock, wait.user, wait.user, ','.join(waiting))
+        except LockBotException as exc:
+            self.logger.info("api: could not give up waits of %s: %s", wait.user, exc.msg)
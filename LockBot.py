@@ -1,54 +1,136 @@
+import time
+
 from twisted.words.protocols import irc
-from twisted.internet import protocol
+from twisted.internet import protocol, reactor, task
 
-from LockBotBrain import LockBotBrain
+from Namespaces import BrainPool, ircfold
+from LockBotBrain import LockBotException, cleannick
+from SendQueue import SendQueue
 import Logger
 
 class LockBot(irc.IRCClient):
     def __init__(self):
-        self.brain = None
+        self.sendqueue = None
+        self.reclaim = None
         self.logger = Logger.Logger()
 
-    def _get_nickname(self):
-        return self.factory.nickname
-    nickname = property(_get_nickname)
+    def connectionMade(self):
+        self.nickname = self.factory.nickname
+        irc.IRCClient.connectionMade(self)
 
     def _get_password(self):
         return self.factory.password
     password = property(_get_password)
 
-    def _get_dbdir(self):
-        return self.factory.dbdir
-    dbdir = property(_get_dbdir)
-
     def signedOn(self):
-        self.logger.info("Signed on as %s." % (self.nickname))
-        self.brain = LockBotBrain(self.nickname, self.dbdir)
-        self.join(self.factory.channel)
+        self.logger.info("Signed on as %s.", self.nickname)
+        self.sendqueue = SendQueue(self.msg, reactor,
+                                   rate=self.factory.linerate,
+                                   burst=self.factory.lineburst)
+        self.factory.bot = self
+        for channel in self.factory.channels:
+            self.join(channel)
+        if self.nickname != self.factory.nickname:
+            self.reclaim = task.LoopingCall(self.setNick, self.factory.nickname)
+            self.reclaim.start(10, now=False)
+
+    def alterCollidedNick(self, nickname):
+        # Answer as <nickname>_ while the nickname is taken, e.g. by a
+        # crashed instance the server has not timed out yet, adding an
+        # underscore on every further collision, and keep trying to get
+        # it back.
+        return nickname + '_'
+
+    def nickChanged(self, nick):
+        irc.IRCClient.nickChanged(self, nick)
+        self.logger.info("Nickname is now %s.", nick)
+        if nick == self.factory.nickname and self.reclaim:
+            self.reclaim.stop()
+            self.reclaim = None
+
+    def connectionLost(self, reason):
+        if self.factory.bot is self:
+            self.factory.bot = None
+        if self.sendqueue:
+            self.sendqueue.stop()
+        if self.reclaim:
+            self.reclaim.stop()
+            self.reclaim = None
+        irc.IRCClient.connectionLost(self, reason)
 
     def joined(self, channel):
-        self.logger.info("Joined %s." % (channel))
+        self.logger.info("Joined %s.", channel)
+        self.logger.debug("joined %s %.3fs after start", channel,
+                          time.time() - self.factory.started)
 
     def privmsg(self, user, channel, msg):
-        self.logger.debug("received: %s" % msg)
+        self.logger.debug("received: %s", msg)
 
-        responses = self.brain.processPrivMsg(user, channel, msg)
-        for channel, message in responses:
-            self.msg(channel, message)
+        # private messages go to the primary namespace
+        if channel == self.nickname:
+            brain = self.factory.brains.get()
+            channel = self.factory.nickname
+        elif ircfold(channel) in self.factory.brains.channels:
+            brain = self.factory.brains.get(channel)
+        else:
+            return
+        responses, urgent = brain.respond(user, channel, msg)
+        self.sendqueue.put(responses, urgent=urgent)
+
+    def userQuit(self, user, quitMessage):
+        if self.factory.releaseonquit:
+            self.release(user, 'quit')
+
+    def userRenamed(self, oldname, newname):
+        # "nick" and "nick_" are the same person, see cleannick
+        if self.factory.releaseonquit and cleannick(oldname) != cleannick(newname):
+            self.release(oldname, 'is now known as %s' % newname)
+
+    def release(self, nick, reason):
+        """unlock everything nick holds or waits for, in every namespace"""
+        nick = cleannick(nick)
+        for channel in self.factory.channels:
+            # QUITs are frequent, don't load namespaces just to find nothing
+            if not self.factory.brains.involves(channel, nick):
+                continue
+            brain = self.factory.brains.get(channel)
+            try:
+                responses = brain.run(brain.unlock, nick, channel, '*')
+            except LockBotException:
+                continue
+            self.logger.info("%s %s, released its locks in %s", nick, reason, channel)
+            # may hand the locks to waiters
+            self.sendqueue.put(responses, urgent=True)
 
 class LockBotFactory(protocol.ClientFactory):
     protocol = LockBot
 
-    def __init__(self, channel, nickname, dbdir, password=None):
-        self.channel = channel
+    def __init__(self, channels, nickname, dbdir, password=None, storage='log',
+                 linerate=0.5, lineburst=5, idletime=3600, started=None,
+                 releaseonquit=False, storeoptions=None):
+        self.started = started or time.time()
+        self.channels = channels
         self.nickname = nickname
         self.password = password
-        self.dbdir = dbdir
+        self.brains = BrainPool(channels, nickname, dbdir, storage,
+                                clock=reactor, idletime=idletime,
+                                storeoptions=storeoptions)
+        self.brains.announcers.append(self.announce)
+        self.bot = None
+        self.linerate = linerate
+        self.lineburst = lineburst
+        self.releaseonquit = releaseonquit
         self.logger = Logger.Logger()
 
+    def announce(self, messages, urgent=False):
+        if not self.bot:
+            self.logger.info("not connected, dropping: %s", messages)
+            return
+        self.bot.sendqueue.put(messages, urgent)
+
     def clientConnectionLost(self, connector, reason):
-        self.logger.critical("Lost connection (%s), reconnecting." % (reason,))
+        self.logger.critical("Lost connection (%s), reconnecting.", reason)
         connector.connect()
 
     def clientConnectionFailed(self, connector, reason):
-        self.logger.critical("Could not connect: %s" % (reason,))
+        self.logger.critical("Could not connect: %s", reason)
@@ -1,17 +1,105 @@
 import re
 import os
-import dumbdbm
+import time
+import bisect
+import heapq
+import fnmatch
 import inspect
-
-import Levenshtein
+import itertools
+from collections import OrderedDict
 
 import Logger
+import Metrics
+import LockStore
+from NameIndex import NameIndex
+from Leases import LeaseTimer, parseduration, formatduration
+from Journal import Journal, readevents, analyze, describe
 
 DBNAME = 'locks'
+JOURNALNAME = 'journal'
+
+# seconds of waiting that are worth one level of waiter priority
+AGING = 600
+
+# store keys of pool queues; resource names may not start with it
+POOLPREFIX = 'pool:'
+POOLNAME = re.compile(r'^[\w.-]+$')
+# "pool:arm64" or "2 from pool:arm64"
+POOLREQUEST = re.compile(r'^\s*(?:(\d+)\s+from\s+)?pool:([\w.-]+)\s*$')
+
+# glob selectors such as "lab1-rack3-*"; the part before the first
+# wildcard is the prefix the matching names are looked up by
+SELECTOR = re.compile(r'[*?[]')
+# resources a single selector may stand for
+MAXSELECT = 200
+
+# watch events reaching a subscriber within this many seconds go out together
+BATCHSECONDS = 2
+# events per private message sent to a watching nick
+EVENTSPERLINE = 8
+
+# journal bytes a stats command reads at most, newest first; it runs on
+# the reactor, so this bounds how long everything else waits for it;
+# Report.py reads the whole journal offline
+STATSBYTES = 2 * 1024 * 1024
+
+# rules starting with this accept their command without addressing the bot
+OPTIONALPREFIX = '^\s*(?:@BOTNAME@:)?\s*'
+
+COMMANDSECONDS = Metrics.REGISTRY.histogram(
+    'lockbot_command_seconds', 'time spent running a command, by command')
+STORESECONDS = Metrics.REGISTRY.histogram(
+    'lockbot_store_commit_seconds', 'time spent committing changes to storage')
+GRANTWAITSECONDS = Metrics.REGISTRY.histogram(
+    'lockbot_grant_wait_seconds', 'time from queueing for a resource to getting it')
+GRANTS = Metrics.REGISTRY.counter('lockbot_grants_total', 'resource locks granted')
+DENIALS = Metrics.REGISTRY.counter('lockbot_denials_total',
+                                   'lock requests denied because a resource was taken')
+WAITS = Metrics.REGISTRY.counter('lockbot_waits_total',
+                                 'lock requests queued behind another owner')
+
+# per brain gauges, registered by whoever owns the brains
+GAUGES = [
+    ('lockbot_resources_registered', 'registered resources',
+     lambda brain: len(brain.views.all)),
+    ('lockbot_resources_held', 'resources currently locked',
+     lambda brain: len(brain.views.locked)),
+    ('lockbot_resources_free', 'resources currently unlocked',
+     lambda brain: len(brain.views.free)),
+    ('lockbot_waiters', 'queued lock requests over all resources',
+     lambda brain: sum(brain.locks[k].waitcount() for k in brain.views.locked)),
+    ('lockbot_pool_requests', 'queued pool lock requests',
+     lambda brain: sum(len(q.requests) for q in brain.locks.queues.values())),
+    ('lockbot_watches', 'subscriptions to resources and pools',
+     lambda brain: len(brain.watchers)),
+]
+
+# trailing options accepted after the resources of lock commands
+OPTIONS = [
+    ('lease', re.compile(r'\s+for\s+(\d+\s*[smhd])\s*$'),
+     lambda m: parseduration(m.group(1))),
+    ('atomic', re.compile(r'\s+together\s*$'),
+     lambda m: True),
+    ('priority', re.compile(r'\s+priority\s+(-?\d+)\s*$'),
+     lambda m: int(m.group(1))),
+]
 
 def cleannick(nick):
     return nick.rstrip('_')
 
+# resource names and nicks end up in comma separated, ';' attributed
+# lock entries
+NAME = re.compile(r'^[^\s,;]+$')
+
+# Lock entries may carry attributes after the nickname, "nick;key=value".
+# ';' can't appear in a nickname, and plain entries read back as before.
+def splitattrs(entry):
+    fields = entry.split(';')
+    return fields[0], dict(f.split('=', 1) for f in fields[1:])
+
+def joinattrs(name, attrs):
+    return ';'.join([name] + ['%s=%s' % (k, v) for k, v in sorted(attrs.items()) if v])
+
 class LockBotException(Exception):
     def __init__(self, msg, resourcestr, verb):
         super(LockBotException, self).__init__()
@@ -19,15 +107,43 @@ class LockBotException(Exception):
         self.resourcestr = resourcestr
         self.verb = verb
 
+# tie breaker keeping waiters with equal keys in the order they queued
+SEQUENCE = itertools.count()
+
 class Lock(object):
+    # One of these exists per resource in use, so they carry no __dict__
+    # and allocate waiter structures only while somebody waits. Nicks and
+    # names are interned, every lock holding a nick shares one string.
+    __slots__ = ('db', 'name', '_owner', 'expires', 'ttl', 'pools',
+                 '_waiters', '_entries', '_order')
+
     def __init__(self, db, name, lockstr=''):
         self.db = db
-        self.name = name
-        self.lockstr = lockstr
+        self.name = intern(name)
 
         owner, waiters = self.fromstr(lockstr)
-        self._owner = owner
-        self._waiters = waiters
+        owner, attrs = splitattrs(owner)
+        self._owner = intern(owner)
+        # lease of the current owner: expiry time and duration in seconds
+        self.expires = int(attrs.get('exp', 0))
+        self.ttl = int(attrs.get('ttl', 0))
+        self.pools = tuple(p for p in attrs.get('pool', '').split('+') if p)
+        # Waiters are served by the time they queued at, moved forward AGING
+        # seconds per level of priority, so low priority requests still get
+        # their turn eventually. The heap holds [key, seq, nick, priority,
+        # queued, lease, group] entries, lease being the duration asked for
+        # and group the all-or-nothing request queued for (see WaitGraph).
+        # _entries finds the entry of a nick; cancelled entries stay behind
+        # in the heap with nick set to None. _order caches the queue in
+        # serving order until it changes.
+        self._waiters = None
+        self._entries = None
+        self._order = None
+        for waiter in waiters:
+            waiter, attrs = splitattrs(waiter)
+            # entries written before priorities keep their order
+            self.push(waiter, int(attrs.get('pri', 0)), int(attrs.get('t', 0)),
+                      int(attrs.get('ttl', 0)), attrs.get('all'))
 
     @property
     def owner(self):
@@ -35,83 +151,629 @@ class Lock(object):
 
     @owner.setter
     def owner(self, owner):
-        self._owner = owner
+        self._owner = intern(owner)
+        self.expires = 0
+        self.ttl = 0
+        self.sync()
+
+    def lease(self, ttl, expires):
+        self.ttl = ttl
+        self.expires = expires
         self.sync()
 
+    def tag(self, pool):
+        if pool not in self.pools:
+            self.pools += (pool,)
+            self.sync()
+
+    def untag(self, pool):
+        if pool in self.pools:
+            self.pools = tuple(p for p in self.pools if p != pool)
+            self.sync()
+
     @property
     def waiters(self):
-        return self._waiters
+        """the waiters in the order they will be served"""
+        if not self._entries:
+            return []
+        return [entry[2] for entry in self.ordered()]
+
+    def ordered(self):
+        if self._order is None:
+            self._order = sorted(self._entries.itervalues())
+        return self._order
+
+    def waitcount(self):
+        return len(self._entries) if self._entries else 0
+
+    def haswaiter(self, waiter):
+        return bool(self._entries) and waiter in self._entries
+
+    def waiterset(self):
+        return self._entries.keys() if self._entries else []
+
+    def waitttl(self, waiter):
+        """lease duration waiter asked for"""
+        return self._entries[waiter][5] if self.haswaiter(waiter) else 0
+
+    def waitgroup(self, waiter):
+        """all-or-nothing request waiter queues for"""
+        return self._entries[waiter][6] if self.haswaiter(waiter) else None
 
-    def wait(self, waiter):
-        if waiter not in self._waiters:
-            self._waiters.append(waiter)
+    def waitrequest(self, waiter):
+        """(priority, queued at, lease, group) of waiter's request"""
+        return tuple(self._entries[waiter][3:])
+
+    def firstwaiter(self):
+        if not self._entries:
+            return None
+        while self._waiters[0][2] is None:
+            heapq.heappop(self._waiters)
+        return self._waiters[0][2]
+
+    def push(self, waiter, priority, queued, ttl=0, group=None):
+        waiter = intern(waiter)
+        entry = [queued - priority * AGING, next(SEQUENCE), waiter, priority,
+                 queued, ttl, group]
+        if self._entries is None:
+            self._entries = {}
+            self._waiters = []
+        self._entries[waiter] = entry
+        heapq.heappush(self._waiters, entry)
+        self._order = None
+
+    def wait(self, waiter, ttl=0, group=None, priority=0, queued=0):
+        if not self.haswaiter(waiter):
+            self.push(waiter, priority, queued, ttl, group)
+        else:
+            entry = self._entries[waiter]
+            entry[5] = ttl or entry[5]
+            entry[6] = group or entry[6]
         self.sync()
 
     def popwaiter(self, waiter=None):
-        if not self._waiters:
+        if not self._entries:
             return None
         if not waiter:
-            waiter = self._waiters.pop(0)
+            self.firstwaiter()
+            waiter = heapq.heappop(self._waiters)[2]
+            del self._entries[waiter]
         else:
-            self._waiters.remove(waiter)
+            self._entries.pop(waiter)[2] = None
+            # drop cancelled entries once they make up most of the heap
+            if len(self._waiters) > 2 * len(self._entries) + 8:
+                self._waiters = sorted(self._entries.itervalues())
+        self._order = None
+        if not self._entries:
+            self._entries = None
+            self._waiters = None
         self.sync()
 
         return waiter
 
     def fromstr(self, lockstr):
         if not lockstr:
-            return '', []
+            return '', ()
         flds = lockstr.split(',')
 
         return flds[0], flds[1:]
 
     def tostr(self):
-        return ','.join([self.owner] + self._waiters)
+        owner = joinattrs(self.owner, {'exp': self.expires, 'ttl': self.ttl,
+                                       'pool': '+'.join(self.pools)})
+        if not self._entries:
+            return owner
+        waiters = [joinattrs(w, {'ttl': ttl, 'all': group, 'pri': pri, 't': queued})
+                   for _, _, w, pri, queued, ttl, group in self.ordered()]
+        return ','.join([owner] + waiters)
+
+    def sync(self):
+        self.db.touch(self.name)
+
+class PoolQueue(object):
+    # Requests waiting for members of a pool, oldest first, stored as
+    # "nick;n=<members still wanted>;t=<queued at>;ttl=<lease>,...".
+    def __init__(self, db, pool, queuestr=''):
+        self.db = db
+        self.pool = pool
+        self.requests = []
+        for entry in queuestr.split(',') if queuestr else []:
+            nick, attrs = splitattrs(entry)
+            self.requests.append([nick, int(attrs.get('n', 1)),
+                                  int(attrs.get('t', 0)), int(attrs.get('ttl', 0))])
+
+    def find(self, nick):
+        for request in self.requests:
+            if request[0] == nick:
+                return request
+        return None
+
+    def put(self, nick, count, queued, ttl=0):
+        self.requests.append([nick, count, queued, ttl])
+        self.sync()
+
+    def take(self):
+        """count one member granted to the first request, returns it"""
+        request = self.requests[0]
+        request[1] -= 1
+        if not request[1]:
+            self.requests.pop(0)
+        self.sync()
+        return request
+
+    def remove(self, nick):
+        self.requests = [r for r in self.requests if r[0] != nick]
+        self.sync()
+
+    def tostr(self):
+        return ','.join(joinattrs(nick, {'n': n, 't': t, 'ttl': ttl})
+                        for nick, n, t, ttl in self.requests)
 
     def sync(self):
-        self.db[self.name] = self.tostr()
+        self.db.touch(POOLPREFIX + self.pool)
 
 class LockDB(object):
-    def __init__(self, path):
-        self.db = dumbdbm.open(path)
+    # The whole table is loaded once, reads never touch the disk. raw keeps
+    # the stored entry of every resource, a Lock is only made from it when
+    # first asked for. Mutations only mark locks dirty and are handed to the
+    # store together by commit().
+    def __init__(self, store):
+        self.store = store
+        self.raw = dict(store.load())
+        self.table = {}
+        self.queues = {}
+        for k in [k for k in self.raw if k.startswith(POOLPREFIX)]:
+            pool = k[len(POOLPREFIX):]
+            self.queues[pool] = PoolQueue(self, pool, self.raw.pop(k))
+        self.dirty = set()
+        self.listeners = []
+        self.commitlisteners = []
+
+    def touch(self, name):
+        self.dirty.add(name)
+        for listener in self.listeners:
+            listener(name)
+
+    def commit(self):
+        if not self.dirty:
+            return
+        changes = [(name, self.entry(name)) for name in self.dirty]
+        self.dirty.clear()
+        with STORESECONDS.time():
+            self.store.commit(changes)
+        for listener in self.commitlisteners:
+            listener(changes)
+
+    def entry(self, name):
+        if name in self.table:
+            return self.table[name].tostr()
+        if name in self.raw:
+            return self.raw[name]
+        queue = self.queues.get(name[len(POOLPREFIX):])
+        if name.startswith(POOLPREFIX) and queue and queue.requests:
+            return queue.tostr()
+        return None
+
+    def dump(self):
+        """every entry as the store holds it once committed"""
+        entries = [(name, self.entry(name)) for name in self.raw]
+        entries += [(POOLPREFIX + pool, queue.tostr())
+                    for pool, queue in self.queues.items() if queue.requests]
+        return entries
 
     def add(self, name):
-        self[name] = Lock(self.db, name)
+        name = intern(name)
+        self[name] = Lock(self, name)
+
+    def queue(self, pool):
+        """the request queue of pool, created on first use"""
+        if pool not in self.queues:
+            self.queues[pool] = PoolQueue(self, pool)
+        return self.queues[pool]
+
+    def held(self):
+        """names of the locked resources"""
+        held = set(k for k, v in self.raw.iteritems() if v and v[0] not in ',;')
+        for name, lock in self.table.items():
+            if lock.owner:
+                held.add(name)
+            else:
+                held.discard(name)
+        return held
+
+    def owner(self, name):
+        """owner of name, '' if there is none, without building its Lock"""
+        lock = self.table.get(name)
+        if lock is not None:
+            return lock.owner
+        return intern(self.raw.get(name, '').split(',', 1)[0].split(';', 1)[0])
+
+    def search(self, text):
+        """names whose stored entry contains text"""
+        return [k for k, v in self.raw.iteritems()
+                if k not in self.table and text in v] + \
+               [k for k, lock in self.table.items() if text in lock.tostr()]
+
+    def get(self, name):
+        if name not in self.raw:
+            return None
+        return self[name]
 
     def keys(self):
-        return self.db.keys()
+        return self.raw.keys()
 
     def items(self):
-        return [(k, Lock(self.db, k, v)) for k, v in self.db.items()]
+        return [(name, self[name]) for name in self.raw]
 
     def __iter__(self):
-        return self.db.__iter__()
+        return self.raw.__iter__()
+
+    def __contains__(self, name):
+        return name in self.raw
 
     def __len__(self):
-        return len(self.keys())
+        return len(self.raw)
 
     def __getitem__(self, name):
-        return Lock(self.db, name, self.db[name])
+        lock = self.table.get(name)
+        if lock is None:
+            lock = self.table[name] = Lock(self, name, self.raw[name])
+        return lock
 
     def __setitem__(self, name, lock):
-        self.db[name] = lock.tostr()
+        self.table[name] = lock
+        self.raw[name] = lock.tostr()
+        self.touch(name)
 
     def __delitem__(self, name):
-        del self.db[name]
+        del self.raw[name]
+        self.table.pop(name, None)
+        self.touch(name)
+
+class LockViews(object):
+    # Sorted name lists for the listing commands, kept current from LockDB
+    # change notifications. Rendered listings are cached until the next
+    # change.
+    def __init__(self, locks):
+        self.locks = locks
+        self.all = sorted(locks.keys())
+        held = locks.held()
+        self.locked = [k for k in self.all if k in held]
+        self.free = [k for k in self.all if k not in held]
+        self.cache = {}
+        locks.listeners.append(self.changed)
+
+    def changed(self, name):
+        lock = self.locks.get(name)
+        self.place(self.all, name, lock is not None)
+        self.place(self.locked, name, lock is not None and bool(lock.owner))
+        self.place(self.free, name, lock is not None and not lock.owner)
+        self.cache.clear()
+
+    def place(self, names, name, member):
+        i = bisect.bisect_left(names, name)
+        present = i < len(names) and names[i] == name
+        if member and not present:
+            names.insert(i, name)
+        elif present and not member:
+            del names[i]
+
+    def select(self, pattern, names=None, limit=None):
+        """the names matching the glob pattern in sorted order, at most
+        limit of them; only the names sharing its literal prefix are read"""
+        if names is None:
+            names = self.all
+        m = SELECTOR.search(pattern)
+        prefix = pattern[:m.start()] if m else pattern
+        anything = pattern == prefix + '*'
+        matches = []
+        i = bisect.bisect_left(names, prefix)
+        while i < len(names) and names[i].startswith(prefix):
+            if anything or fnmatch.fnmatchcase(names[i], pattern):
+                matches.append(names[i])
+                if len(matches) == limit:
+                    break
+            i += 1
+        return matches
+
+    def render(self, key, fn):
+        if key not in self.cache:
+            self.cache[key] = fn()
+        return self.cache[key]
+
+class PoolIndex(object):
+    # Members and free members of every pool, kept current from LockDB
+    # change notifications. Free members are kept in the order they were
+    # released, so allocation hands out the one idle for longest.
+    def __init__(self, locks):
+        self.locks = locks
+        self.members = {}
+        self.free = {}
+        self.poolsof = {}
+        for name in sorted(locks.search(';pool=')):
+            self.changed(name)
+        locks.listeners.append(self.changed)
+
+    def changed(self, name):
+        lock = self.locks.get(name)
+        pools = list(lock.pools) if lock else []
+        for pool in self.poolsof.pop(name, []):
+            if pool not in pools:
+                self.members[pool].discard(name)
+                self.free[pool].pop(name, None)
+                if not self.members[pool]:
+                    del self.members[pool]
+                    del self.free[pool]
+        for pool in pools:
+            self.members.setdefault(pool, set()).add(name)
+            free = self.free.setdefault(pool, OrderedDict())
+            if lock.owner:
+                free.pop(name, None)
+            elif name not in free:
+                free[name] = True
+        if pools:
+            self.poolsof[name] = pools
+
+class HolderIndex(object):
+    # The resources every nick owns, kept current from LockDB change
+    # notifications. What a nick waits for is in WaitGraph.waits.
+    def __init__(self, locks):
+        self.locks = locks
+        self.owns = {}
+        self.ownerof = {}
+        for name in locks.held():
+            owner = self.ownerof[name] = locks.owner(name)
+            self.owns.setdefault(owner, set()).add(name)
+        locks.listeners.append(self.changed)
+
+    def changed(self, name):
+        owner = self.locks.owner(name)
+        previous = self.ownerof.get(name, '')
+        if owner == previous:
+            return
+        if previous:
+            del self.ownerof[name]
+            self.owns[previous].discard(name)
+            if not self.owns[previous]:
+                del self.owns[previous]
+        if owner:
+            self.ownerof[name] = owner
+            self.owns.setdefault(owner, set()).add(name)
+
+class WaitGraph(object):
+    # Who queues for which resources, kept current from LockDB change
+    # notifications. A nick waits for the owners of those resources; these
+    # are the edges of the wait-for graph. groups maps every all-or-nothing
+    # request, (nick, id), to the resources it asked for.
+    def __init__(self, locks):
+        self.locks = locks
+        self.waits = {}
+        self.groups = {}
+        self.waitersof = {}
+        for name in locks.search(','):
+            self.changed(name)
+        locks.listeners.append(self.changed)
+
+    def changed(self, name):
+        lock = self.locks.get(name)
+        waiters = [(w, lock.waitgroup(w)) for w in lock.waiterset()] if lock else []
+        for nick, group in self.waitersof.pop(name, []):
+            self.discard(self.waits, nick, name)
+            if group:
+                self.discard(self.groups, (nick, group), name)
+        for nick, group in waiters:
+            self.waits.setdefault(nick, set()).add(name)
+            if group:
+                self.groups.setdefault((nick, group), set()).add(name)
+        if waiters:
+            self.waitersof[name] = waiters
+
+    def discard(self, index, key, name):
+        index[key].discard(name)
+        if not index[key]:
+            del index[key]
+
+    def newgroup(self, nick, now):
+        group = int(now)
+        while (nick, str(group)) in self.groups:
+            group += 1
+        return str(group)
+
+    def path(self, src, dst, owners={}):
+        """nicks on a chain of waits from src to dst, None if there is none;
+        owners overrides the owner of some resources"""
+        parents = {src: None}
+        stack = [src]
+        while stack:
+            nick = stack.pop()
+            if nick == dst:
+                path = []
+                while nick is not None:
+                    path.append(nick)
+                    nick = parents[nick]
+                return path[::-1]
+            for name in self.waits.get(nick, ()):
+                owner = owners.get(name, self.locks[name].owner)
+                if owner and owner not in parents:
+                    parents[owner] = nick
+                    stack.append(owner)
+        return None
+
+def eventtext(event):
+    kind, name, owner, previous = event
+    if kind == 'granted':
+        return '%s locked by %s' % (name, owner)
+    if kind == 'released':
+        return '%s freed by %s' % (name, previous)
+    if kind == 'promoted':
+        return '%s handed from %s to %s' % (name, previous, owner)
+    return '%s %s' % (name, kind)
+
+class Watchers(object):
+    # Subscriptions to resources and pools. Every commit is compared with
+    # the state last seen of the watched resources; the resulting events,
+    # (kind, resource, owner, previous owner), are collected per subscriber
+    # and handed to deliver at most every BATCHSECONDS. Subscribers are
+    # nicks or callables taking a list of events.
+    def __init__(self, locks, pools, clock, deliver):
+        self.locks = locks
+        self.pools = pools
+        self.clock = clock
+        self.deliver = deliver
+        # resource or pool:<name> -> subscribers
+        self.topics = {}
+        # watched resource -> (owner, None if unregistered, and pools)
+        self.seen = {}
+        self.pending = OrderedDict()
+        self.call = None
+        locks.commitlisteners.append(self.committed)
+
+    def state(self, name):
+        lock = self.locks.get(name)
+        return (lock.owner, lock.pools) if lock else (None, ())
+
+    def add(self, subscriber, topic):
+        subscribers = self.topics.setdefault(topic, [])
+        if subscriber not in subscribers:
+            subscribers.append(subscriber)
+        if topic.startswith(POOLPREFIX):
+            names = self.pools.members.get(topic[len(POOLPREFIX):], ())
+        else:
+            names = [topic]
+        for name in names:
+            if name not in self.seen:
+                self.seen[name] = self.state(name)
+
+    def remove(self, subscriber, topic):
+        subscribers = self.topics.get(topic, [])
+        if subscriber not in subscribers:
+            return False
+        subscribers.remove(subscriber)
+        if not subscribers:
+            del self.topics[topic]
+        return True
+
+    def drop(self, subscriber):
+        """cancel every subscription of subscriber"""
+        for topic in list(self.topics):
+            self.remove(subscriber, topic)
+        self.pending.pop(subscriber, None)
+
+    def watching(self, subscriber, topic):
+        return subscriber in self.topics.get(topic, ())
+
+    def subscribers(self, name, pools):
+        subscribers = list(self.topics.get(name, ()))
+        for pool in pools:
+            for subscriber in self.topics.get(POOLPREFIX + pool, ()):
+                if subscriber not in subscribers:
+                    subscribers.append(subscriber)
+        return subscribers
+
+    def committed(self, changes):
+        if not self.topics:
+            self.seen.clear()
+            return
+        for name, _ in sorted(changes):
+            if name.startswith(POOLPREFIX):
+                continue
+            owner, pools = self.state(name)
+            before = self.seen.get(name)
+            subscribers = self.subscribers(name, set(pools).union(before[1] if before else ()))
+            if not subscribers:
+                self.seen.pop(name, None)
+                continue
+            self.seen[name] = (owner, pools)
+            # resources just tagged into a watched pool have no history yet
+            if before is None or before[0] == owner:
+                continue
+            if before[0] is None:
+                event = ('registered', name, owner, '')
+            elif owner is None:
+                event = ('unregistered', name, '', before[0])
+            elif not before[0]:
+                event = ('granted', name, owner, '')
+            elif not owner:
+                event = ('released', name, '', before[0])
+            else:
+                event = ('promoted', name, owner, before[0])
+            for subscriber in subscribers:
+                # nobody needs telling about their own grants
+                if subscriber != owner:
+                    self.pending.setdefault(subscriber, []).append(event)
+        if self.pending and self.call is None:
+            self.call = self.clock.callLater(BATCHSECONDS, self.flush)
+
+    def flush(self):
+        self.call = None
+        pending, self.pending = self.pending, OrderedDict()
+        for subscriber, events in pending.items():
+            self.deliver(subscriber, events)
+
+    def stop(self):
+        if self.call is not None:
+            self.call.cancel()
+            self.call = None
+
+    def __len__(self):
+        return sum(len(subscribers) for subscribers in self.topics.values())
 
 class LockBotBrain(object):
 
-    def __init__(self, nickname, dbdir):
+    # replies of these commands can wait behind lock grants and denials
+    bulkcommands = ('status', 'listfree', 'list', 'listpools', 'mylocks', 'whohas', 'stats',
+                    'help')
+
+    def __init__(self, nickname, dbdir, storage='log', clock=None, storeoptions=None):
 
         if not os.path.isdir(dbdir):
             os.mkdir(dbdir)
         dbpath = os.path.join(dbdir, DBNAME)
 
-        self.locks = LockDB(dbpath)
+        started = time.time()
+        self.locks = LockDB(LockStore.openstore(storage, dbpath, storeoptions))
+        loaded = time.time()
+        self.names = NameIndex(self.locks.keys())
+        self.views = LockViews(self.locks)
+        self.pools = PoolIndex(self.locks)
+        self.graph = WaitGraph(self.locks)
+        self.holders = HolderIndex(self.locks)
         self.nickname = nickname
         self.rules = self.interpolateRules(nickname)
+        self.prefilter, self.dispatcher, self.handlers = self.compileRules(nickname, self.rules)
         self.logger = Logger.Logger()
+        self.logger.debug("loaded %d resources from %s in %.3fs, indexed in %.3fs",
+                          len(self.locks), dbdir, loaded - started, time.time() - loaded)
         self.verb = None
+        self.announcers = []
+
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.leases = LeaseTimer(clock, self.expire)
+        self.journal = Journal(os.path.join(dbdir, JOURNALNAME), self.checkpoint,
+                               now=clock.seconds())
+        self.locks.commitlisteners.append(lambda changes: self.journal.flush())
+        self.watchers = Watchers(self.locks, self.pools, clock, self.deliver)
+        # (resource, nick) -> when nick started waiting for resource
+        self.waitstarted = {}
+        # front ends holding on to this brain, see idle()
+        self.pinned = 0
+        for name in self.locks.search(';exp='):
+            lock = self.locks[name]
+            if lock.expires:
+                self.leases.schedule(name, lock.expires)
+
+    def idle(self):
+        """whether the brain can be closed without losing pending work"""
+        return not self.pinned and not len(self.leases) and not self.watchers.topics
+
+    def close(self):
+        self.leases.stop()
+        self.watchers.stop()
+        self.locks.commit()
+        self.locks.store.close()
+        self.journal.close()
 
     def interpolateRules(self, nickname):
         rules = self.getRules()
@@ -122,6 +784,42 @@ class LockBotBrain(object):
             irules.append(irule)
         return irules
 
+    def compileRules(self, nickname, rules):
+        # All rules are folded into one alternation, tried in order like the
+        # list itself; the outer named group tells which rule matched.
+        alternatives = []
+        handlers = {}
+        offset = 0
+        for i, (regexp, handler) in enumerate(rules):
+            name = 'rule%d' % i
+            alternatives.append('(?P<%s>%s)' % (name, regexp))
+            ngroups = re.compile(regexp).groups
+            handlers[name] = (offset + 1, ngroups, handler)
+            offset += ngroups + 1
+        dispatcher = re.compile('|'.join(alternatives))
+
+        # Cheap test rejecting chatter: every rule either starts with the
+        # bot name or with a command keyword that may go without it.
+        keywords = []
+        for regexp, _ in self.getRules():
+            m = re.match(re.escape(OPTIONALPREFIX) + r'(\w+)', regexp)
+            if m:
+                keywords.append(m.group(1))
+            elif not regexp.lstrip('^').startswith('@BOTNAME@:'):
+                return re.compile(''), dispatcher, handlers
+        prefilter = re.compile(r'^\s*(?:%s:|(?:%s)\b)' % (nickname, '|'.join(keywords)))
+
+        return prefilter, dispatcher, handlers
+
+    def matchRule(self, msg):
+        if not self.prefilter.match(msg):
+            return None, ()
+        m = self.dispatcher.match(msg)
+        if not m:
+            return None, ()
+        offset, ngroups, handler = self.handlers[m.lastgroup]
+        return handler, m.groups()[offset:offset + ngroups]
+
     def getErrorMessages(self, nick, channel, exc):
         if ',' in exc.resourcestr:
             return [(channel, '%s: %s' % (nick, exc.msg)),
@@ -130,14 +828,19 @@ class LockBotBrain(object):
             return (channel, exc.msg)
 
     def processPrivMsg(self, user, channel, msg):
+        return self.respond(user, channel, msg)[0]
+
+    def respond(self, user, channel, msg):
+        """the replies to msg, and whether they are urgent: those of
+        bulkcommands can wait behind lock grants and denials"""
 
         nick = user.strip().split('!')[0]
-        self.logger.debug("privmsg: user %s, nick %s, channel %s, msg %s" % \
-                              (user, nick, channel, msg))
+        self.logger.debug("privmsg: user %s, nick %s, channel %s, msg %s",
+                          user, nick, channel, msg)
 
         # Ignore my own messages
         if nick == self.nickname:
-            return []
+            return [], False
 
         # Snub private messages
         if channel == self.nickname:
@@ -146,21 +849,31 @@ class LockBotBrain(object):
             msg = '%s: %s' % (self.nickname, msg)
             channel = nick
 
-        for regexp, handler in self.rules:
-            m = re.match(regexp, msg)
-            if m:
-                args = m.groups()
-                self.verb = handler.__name__ + 'ed'
-                try:
-                    response = handler(cleannick(nick), channel, *args)
-                except LockBotException as exc:
-                    response = self.getErrorMessages(nick, channel, exc)
-                self.verb = None
-                if type(response) != list:
-                    response = [response]
-                return response
-
-        return []
+        handler, args = self.matchRule(msg)
+        if not handler:
+            return [], False
+
+        urgent = handler.__name__ not in self.bulkcommands
+        try:
+            return self.run(handler, cleannick(nick), channel, *args), urgent
+        except LockBotException as exc:
+            response = self.getErrorMessages(nick, channel, exc)
+        if type(response) != list:
+            response = [response]
+        return response, urgent
+
+    def run(self, handler, nick, channel, *args):
+        """run one command and commit whatever it changed"""
+        self.verb = handler.__name__ + 'ed'
+        try:
+            with COMMANDSECONDS.time(command=handler.__name__):
+                response = handler(nick, channel, *args)
+        finally:
+            self.verb = None
+            self.locks.commit()
+        if type(response) != list:
+            response = [response]
+        return response
 
     def getRules(self):
         rules = [
@@ -168,8 +881,10 @@ class LockBotBrain(object):
             ('^\s*(?:@BOTNAME@:)?\s*trylock\s+(.*)$',   self.lock),
             ('^\s*(?:@BOTNAME@:)?\s*unlock\((.*)\)$',   self.unlock),
             ('^\s*(?:@BOTNAME@:)?\s*unlock\s+(.*)$',    self.unlock),
+            ('^\s*(?:@BOTNAME@:)?\s*renew\((.*)\)$',    self.renew),
+            ('^\s*(?:@BOTNAME@:)?\s*renew\s+(.*)$',     self.renew),
             ('@BOTNAME@:\s*assignlock\((.*?),(.*)\)$',  self.assignlock),
-            ('@BOTNAME@:\s*assignlock\s+(.*)\s+(.*)$',  self.assignlock),
+            ('@BOTNAME@:\s*assignlock\s+(\S+)\s+(.*)$', self.assignlock),
             ('@BOTNAME@:\s*freelock\((.*)\)$',          self.freelock),
             ('@BOTNAME@:\s*freelock\s+(.*)$',           self.freelock),
             ('^\s*(?:@BOTNAME@:)?\s*lock\((.*)\)$',     self.waitlock),
@@ -178,26 +893,31 @@ class LockBotBrain(object):
             ('@BOTNAME@:\s*register\s+(.*)$',           self.register),
             ('@BOTNAME@:\s*unregister\((.*)\)$',        self.unregister),
             ('@BOTNAME@:\s*unregister\s+(.*)$',         self.unregister),
+            ('@BOTNAME@:\s*tag\((.*?),(.*)\)$',         self.tag),
+            ('@BOTNAME@:\s*tag\s+(\S+)\s+(.*)$',        self.tag),
+            ('@BOTNAME@:\s*untag\((.*?),(.*)\)$',       self.untag),
+            ('@BOTNAME@:\s*untag\s+(\S+)\s+(.*)$',      self.untag),
+            ('@BOTNAME@:\s*watch\((.*)\)$',             self.watch),
+            ('@BOTNAME@:\s*watch\s+(.*)$',              self.watch),
+            ('@BOTNAME@:\s*unwatch\((.*)\)$',           self.unwatch),
+            ('@BOTNAME@:\s*unwatch\s+(.*)$',            self.unwatch),
             ('@BOTNAME@:\s*status\s*$',                 self.status),
+            ('@BOTNAME@:\s*status\s+(\S+)\s*$',          self.status),
             ('@BOTNAME@:\s*listlocked\s*$',             self.status),
             ('@BOTNAME@:\s*listfree\s*$',               self.listfree),
             ('@BOTNAME@:\s*list\s*$',                   self.list),
+            ('@BOTNAME@:\s*listpools\s*$',              self.listpools),
+            ('@BOTNAME@:\s*mylocks\s*$',                self.mylocks),
+            ('@BOTNAME@:\s*whohas\((.*)\)$',            self.whohas),
+            ('@BOTNAME@:\s*whohas\s+(\S+)\s*$',         self.whohas),
+            ('@BOTNAME@:\s*stats\s+(\S+)(?:\s+(\S+))?\s*$', self.stats),
             ('@BOTNAME@:\s*help\s*$',                   self.help),
             ('@BOTNAME@:.*',                            self.defaulthandler),
         ]
         return rules
 
     def getlock(self, name):
-        if name in self.locks:
-            return name
-
-        ratios = [(Levenshtein.ratio(name, l), l) for l in self.locks]
-        best = max(ratios)
-
-        if best[0] < 0.5 or len([c for c in ratios if c[0] == best[0]]) > 1:
-            return name
-
-        return best[1]
+        return self.names.closest(name)
 
     def splitResources(self, resourcestr):
         results = [i.strip() for i in resourcestr.split(',')]
@@ -210,19 +930,61 @@ class LockBotBrain(object):
 
     def getlocks(self, resourcestr):
         resources, multi = self.splitResources(resourcestr)
-        resources = [self.getlock(r) for r in resources]
         for r in resources:
+            if r.startswith(POOLPREFIX):
+                raise LockBotException('ERROR: pools can only be used on their own, '
+                                       'as in "lock 2 from %s"' % r, resourcestr, self.verb)
+        selected = []
+        for r in resources:
+            if not SELECTOR.search(r):
+                matches = [self.getlock(r)]
+            else:
+                matches = self.views.select(r, limit=MAXSELECT + 1)
+                if not matches:
+                    raise LockBotException('ERROR: no resource matches "%s"' % r,
+                                           resourcestr, self.verb)
+                if len(matches) > MAXSELECT:
+                    raise LockBotException('ERROR: "%s" matches more than %d resources' %
+                                           (r, MAXSELECT), resourcestr, self.verb)
+            # selectors may overlap each other and the names given
+            selected += [match for match in matches if match not in selected]
+        for r in selected:
             if r not in self.locks:
                 raise LockBotException('ERROR: unrecognized resource "%s"' % r,
                                        resourcestr, self.verb)
 
-        return resources, multi
-
-    def _lock(self, caller, assignee, resourcestr, wait=False):
+        return selected, len(selected) > 1
+
+    def splitOptions(self, resourcestr):
+        options = {}
+        found = True
+        while found:
+            found = False
+            for name, regexp, parse in OPTIONS:
+                m = regexp.search(resourcestr)
+                if m and name not in options:
+                    options[name] = parse(m)
+                    resourcestr = resourcestr[:m.start()]
+                    found = True
+        return resourcestr, options
+
+    def _lock(self, caller, assignee, resourcestr, wait=False, lease=0):
+        resourcestr, options = self.splitOptions(resourcestr)
+        lease = options.get('lease', lease)
+        m = POOLREQUEST.match(resourcestr)
+        if m:
+            return [self._lockpool(caller, assignee, m.group(2), int(m.group(1) or 1),
+                                   resourcestr, wait, lease)]
         resources, multi = self.getlocks(resourcestr)
+        atomic = wait and options.get('atomic')
+        priority = options.get('priority', 0)
         waiters = []
         # iterate over all resources once to check for errors
         for r in resources:
+            if atomic and self.locks[r].haswaiter(assignee):
+                raise LockBotException("%s already waiting for %s" %
+                                       ('you are' if caller == assignee else assignee + ' is', r),
+                                       resourcestr, self.verb)
             if self.locks[r].owner == assignee:
                 raise LockBotException("%s already hold the lock for resource %s" %
                                        ('you' if self.locks[r].owner == caller else assignee, r),
@@ -231,17 +993,47 @@ class LockBotBrain(object):
                 if wait:
                     waiters.append(r)
                 else:
+                    DENIALS.inc()
                     raise LockBotException("DENIED, %s is already locked by %s" %
                                            (r, self.locks[r].owner), resourcestr, self.verb)
 
+        # refuse waits that would close a cycle in the wait-for graph
+        if atomic and waiters:
+            granted = {}
+        else:
+            granted = dict((r, assignee) for r in resources if r not in waiters)
+        for r in waiters:
+            cycle = self.graph.path(self.locks[r].owner, assignee, granted)
+            if cycle:
+                DENIALS.inc()
+                raise LockBotException("DENIED, waiting for %s would deadlock (%s)" %
+                                       (r, ' -> '.join([assignee] + cycle)),
+                                       resourcestr, self.verb)
+
         # all clear, perform lock
+        now = self.clock.seconds()
+        if atomic and waiters:
+            # queue on every resource, the whole set is granted at once
+            group = self.graph.newgroup(assignee, now)
+            for r in resources:
+                self.locks[r].wait(assignee, lease, group, priority, int(now))
+                self.record('wait', r, assignee)
+                self.waitstarted.setdefault((r, assignee), now)
+            WAITS.inc(len(resources))
+            wmsg = [self.lockstatus(w) for w in waiters]
+            return ['%s: WAITING for %s together (%s)' % (caller, ', '.join(resources),
+                                                          ', '.join(wmsg))]
         owned = []
         for r in resources:
             if r in waiters:
-                self.locks[r].wait(assignee)
+                self.locks[r].wait(assignee, lease, priority=priority, queued=int(now))
+                self.record('wait', r, assignee)
+                self.waitstarted.setdefault((r, assignee), now)
             else:
-                self.locks[r].owner = assignee
+                self.grant(r, assignee, lease, self.waitstarted.pop((r, assignee), None))
                 owned.append(r)
+        GRANTS.inc(len(owned))
+        WAITS.inc(len(waiters))
         msg = ''
         if owned:
             if caller == assignee:
@@ -249,14 +1041,202 @@ class LockBotBrain(object):
             else:
                 own = assignee + " owns"
             msg = "%s: GRANTED, %s %s" %  (caller, own, ', '.join(owned))
+            if lease:
+                msg += " for %s" % formatduration(lease)
             if waiters:
                 msg += " (still waiting for %s)" % ', '.join(waiters)
         elif waiters:
             wmsg = [self.lockstatus(w) for w in waiters]
             msg = '%s: WAITING for %s' % (caller, ', '.join(wmsg))
 
+        return [msg] + self.breakcycles(assignee, owned)
+
+    def _lockpool(self, caller, assignee, pool, count, resourcestr, wait, lease):
+        if count < 1:
+            raise LockBotException('ERROR: lock at least 1 from pool:%s' % pool,
+                                   resourcestr, self.verb)
+        members = self.pools.members.get(pool)
+        if not members:
+            raise LockBotException('ERROR: unrecognized pool "%s"' % pool,
+                                   resourcestr, self.verb)
+        if count > len(members):
+            raise LockBotException('ERROR: pool:%s has %d member%s' %
+                                   (pool, len(members), 's' if len(members) > 1 else ''),
+                                   resourcestr, self.verb)
+        queue = self.locks.queues.get(pool)
+        if queue and queue.find(assignee):
+            raise LockBotException("%s already waiting for pool:%s" %
+                                   ('you are' if caller == assignee else assignee + ' is', pool),
+                                   resourcestr, self.verb)
+        free = self.pools.free[pool]
+        if not wait and len(free) < count:
+            DENIALS.inc()
+            raise LockBotException("DENIED, only %d of pool:%s free" % (len(free), pool),
+                                   resourcestr, self.verb)
+
+        # free members in the order they were released, the rest is queued
+        owned = list(itertools.islice(free, count))
+        for r in owned:
+            self.grant(r, assignee, lease)
+        missing = count - len(owned)
+        if missing:
+            queue = self.locks.queue(pool)
+            queue.put(assignee, missing, int(self.clock.seconds()), lease)
+            self.record('wait', POOLPREFIX + pool, assignee)
+            WAITS.inc()
+        GRANTS.inc(len(owned))
+
+        if not owned:
+            return '%s: WAITING for %d from pool:%s (%d queued)' % (caller, missing, pool,
+                                                                 len(queue.requests))
+        if caller == assignee:
+            own = "you own"
+        else:
+            own = assignee + " owns"
+        msg = "%s: GRANTED, %s %s" % (caller, own, ', '.join(owned))
+        if lease:
+            msg += " for %s" % formatduration(lease)
+        if missing:
+            msg += " (still waiting for %d more from pool:%s)" % (missing, pool)
         return msg
 
+    def grant(self, name, assignee, lease=0, started=None):
+        self.locks[name].owner = assignee
+        if lease:
+            self.grantlease(name, lease)
+        waited = 0
+        if started is not None:
+            waited = self.clock.seconds() - started
+            GRANTWAITSECONDS.observe(waited)
+        self.record('grant', name, assignee, waited)
+
+    def record(self, kind, name, nick, waited=0):
+        self.journal.record(self.clock.seconds(), kind, name, nick, waited,
+                            self.pools.poolsof.get(name, ()))
+
+    def checkpoint(self):
+        """(resource, owner, pools) of every locked resource"""
+        return [(name, owner, self.pools.poolsof.get(name, ()))
+                for name, owner in sorted(self.holders.ownerof.items())]
+
+    def grantlease(self, name, ttl):
+        expires = int(self.clock.seconds()) + ttl
+        self.locks[name].lease(ttl, expires)
+        self.leases.schedule(name, expires)
+
+    def handoff(self, name, caller=None, kind='release'):
+        """free the lock on name and grant it to its first waiter, if any;
+        kind is how the journal records the release"""
+        lock = self.locks[name]
+        self.record(kind, name, lock.owner)
+        lock.owner = ''
+        # the whole queue is only needed behind an all-or-nothing request
+        first = lock.firstwaiter()
+        if lock.waitgroup(first):
+            queue = lock.waiters
+        else:
+            queue = [first] if first else []
+        for assignee in queue:
+            lease = lock.waitttl(assignee)
+            group = lock.waitgroup(assignee)
+            if not group:
+                lock.popwaiter(assignee)
+                return self._lock(caller or assignee, assignee, name, lease=lease)
+            # all-or-nothing requests wait until their whole set is free,
+            # meanwhile the resource goes to whoever queued behind them
+            resources = sorted(self.graph.groups[(assignee, group)])
+            if all(not self.locks[r].owner for r in resources):
+                for r in resources:
+                    self.locks[r].popwaiter(assignee)
+                    self.grant(r, assignee, lease, self.waitstarted.pop((r, assignee), None))
+                GRANTS.inc(len(resources))
+                msg = "%s: GRANTED, you own %s" % (assignee, ', '.join(resources))
+                if lease:
+                    msg += " for %s" % formatduration(lease)
+                return [msg] + self.breakcycles(assignee, resources)
+        return self.feedpool(name)
+
+    def breakcycles(self, owner, names):
+        """drop waits for names that deadlock now that owner holds them"""
+        msgs = []
+        for name in names:
+            for waiter in list(self.locks[name].waiters):
+                cycle = self.graph.path(owner, waiter)
+                if cycle:
+                    self.locks[name].popwaiter(waiter)
+                    self.waitstarted.pop((name, waiter), None)
+                    msgs.append("%s: DEADLOCK (%s), no longer waiting for %s" %
+                                (waiter, ' -> '.join([waiter] + cycle), name))
+        return msgs
+
+    def feedpool(self, name):
+        """grant the free pool member name to the longest queued pool request"""
+        queues = [self.locks.queues[p] for p in self.locks[name].pools
+                  if p in self.locks.queues and self.locks.queues[p].requests]
+        if not queues:
+            return []
+        queue = min(queues, key=lambda q: (q.requests[0][2], q.pool))
+        assignee, missing, queued, ttl = queue.take()
+        self.grant(name, assignee, ttl, queued)
+        GRANTS.inc()
+        msg = "%s: GRANTED, you own %s from pool:%s" % (assignee, name, queue.pool)
+        if ttl:
+            msg += " for %s" % formatduration(ttl)
+        if missing:
+            msg += " (still waiting for %d more)" % missing
+        return [msg] + self.breakcycles(assignee, [name])
+
+    def prunepool(self, pool):
+        """drop the queued requests of a shrunk pool that want more members
+        than are left besides those they already hold"""
+        queue = self.locks.queues.get(pool)
+        if not queue or not queue.requests:
+            return []
+        members = self.pools.members.get(pool, set())
+        msgs = []
+        for nick, missing, _, _ in list(queue.requests):
+            if missing <= len(members) - len(members & self.holders.owns.get(nick, set())):
+                continue
+            queue.remove(nick)
+            if members:
+                msgs.append("%s: no longer waiting, pool:%s is down to %d member%s" %
+                            (nick, pool, len(members), 's' if len(members) > 1 else ''))
+            else:
+                msgs.append("%s: no longer waiting, pool:%s has no members left" % (nick, pool))
+        return msgs
+
+    def poolname(self, pool, resourcestr):
+        if pool.startswith(POOLPREFIX):
+            pool = pool[len(POOLPREFIX):]
+        if not POOLNAME.match(pool):
+            raise LockBotException('ERROR: invalid pool name "%s"' % pool,
+                                   resourcestr, self.verb)
+        return pool
+
+    def expire(self, name, expires):
+        lock = self.locks.get(name)
+        if not lock or not lock.owner or lock.expires != expires:
+            return
+        msgs = ["%s: your lease on %s has expired" % (lock.owner, name)]
+        msgs += self.handoff(name, kind='expire')
+        self.locks.commit()
+        # the expiry hands the lock to the next waiter
+        self.announce([(None, msg) for msg in msgs], urgent=True)
+
+    def announce(self, messages, urgent=False):
+        """push messages not sent in reply to a command; a channel of None
+        stands for the bot's home channel"""
+        for announcer in self.announcers:
+            announcer(messages, urgent)
+
+    def deliver(self, subscriber, events):
+        if callable(subscriber):
+            subscriber(events)
+            return
+        texts = [eventtext(event) for event in events]
+        self.announce([(subscriber, 'watch: ' + '; '.join(texts[i:i + EVENTSPERLINE]))
+                       for i in range(0, len(texts), EVENTSPERLINE)])
+
     def lockstatus(self, name):
         lock = self.locks[name]
         status = ''
@@ -270,8 +1250,8 @@ class LockBotBrain(object):
         return self.name
 
     def lock(self, nick, channel, resourcestr):
-        """take hold of a lock on a resource"""
-        return (channel, self._lock(nick, nick, resourcestr))
+        """take hold of a lock on resources, e.g. "a,b" or "lab1-rack3-*" (append "for 2h" for a lease that expires)"""
+        return [(channel, msg) for msg in self._lock(nick, nick, resourcestr)]
 
     def register(self, nick, channel, resourcestr):
         """add a new resource to the database"""
@@ -280,10 +1260,21 @@ class LockBotBrain(object):
             if r in self.locks:
                 raise LockBotException('ERROR, resource "%s" is already registered' % r,
                                        resourcestr, self.verb)
+            if r.startswith(POOLPREFIX):
+                raise LockBotException('ERROR, resource names may not start with "%s"' %
+                                       POOLPREFIX, resourcestr, self.verb)
+            if not NAME.match(r):
+                raise LockBotException('ERROR, resource names may not contain spaces or ";"',
+                                       resourcestr, self.verb)
+            if SELECTOR.search(r):
+                # it could never be named apart from the ones it matches
+                raise LockBotException('ERROR, resource names may not contain "*", "?" or "["',
+                                       resourcestr, self.verb)
 
         # all clear, register resources
         for r in resources:
             self.locks.add(r)
+            self.names.add(r)
         return (channel,
             "%s: registered resource%s %s" %
                 (nick,
@@ -294,37 +1285,167 @@ class LockBotBrain(object):
         """remove a resource from the database"""
         resources, multi = self.getlocks(resourcestr)
         for r in resources:
-            if self.locks[r]:
+            if self.locks[r].owner:
                 raise LockBotException('ERROR, resource "%s" is locked by %s' %
-                                       (r, self.locks[r]),
+                                       (r, self.locks[r].owner),
                                        resourcestr, self.verb)
 
         # all clear, unregister resources
+        pools = set()
         for r in resources:
+            pools.update(self.locks[r].pools)
             del self.locks[r]
-        return (channel,
-            "%s: removed resource%s %s" %
+            self.names.remove(r)
+        msgs = ["%s: removed resource%s %s" %
                 (nick,
                  's' if multi else '',
-                 ', '.join(resources)))
+                 ', '.join(resources))]
+        for pool in sorted(pools):
+            msgs += self.prunepool(pool)
+        return [(channel, msg) for msg in msgs]
+
+    def tag(self, nick, channel, pool, resourcestr):
+        """add resources to a pool (lock them with "lock 2 from pool:<pool>")"""
+        pool = self.poolname(pool, resourcestr)
+        resources, multi = self.getlocks(resourcestr)
+        for r in resources:
+            if pool in self.locks[r].pools:
+                raise LockBotException('ERROR, resource %s is already in pool:%s' % (r, pool),
+                                       resourcestr, self.verb)
+
+        # all clear, add to pool and hand free members to queued requests
+        msgs = ["%s: added resource%s %s to pool:%s" %
+                (nick, 's' if multi else '', ', '.join(resources), pool)]
+        for r in resources:
+            self.locks[r].tag(pool)
+            if not self.locks[r].owner:
+                msgs += self.feedpool(r)
+        return [(channel, msg) for msg in msgs]
+
+    def untag(self, nick, channel, pool, resourcestr):
+        """remove resources from a pool"""
+        pool = self.poolname(pool, resourcestr)
+        resources, multi = self.getlocks(resourcestr)
+        for r in resources:
+            if pool not in self.locks[r].pools:
+                raise LockBotException('ERROR, resource %s is not in pool:%s' % (r, pool),
+                                       resourcestr, self.verb)
+
+        # all clear, remove from pool
+        for r in resources:
+            self.locks[r].untag(pool)
+        msgs = ["%s: removed resource%s %s from pool:%s" %
+                (nick, 's' if multi else '', ', '.join(resources), pool)]
+        msgs += self.prunepool(pool)
+        return [(channel, msg) for msg in msgs]
+
+    def watchtopics(self, resourcestr):
+        topics, _ = self.splitResources(resourcestr)
+        return [POOLPREFIX + self.poolname(t, resourcestr) if t.startswith(POOLPREFIX)
+                else self.getlock(t) for t in topics]
+
+    def subscribe(self, nick, subscriber, resourcestr):
+        topics = self.watchtopics(resourcestr)
+        for topic in topics:
+            self.watchers.add(subscriber, topic)
+        unknown = [t for t in topics if not t.startswith(POOLPREFIX) and t not in self.locks]
+        msg = "%s: WATCHING %s" % (nick, ', '.join(topics))
+        if unknown:
+            msg += " (not registered yet: %s)" % ', '.join(unknown)
+        return msg
+
+    def unsubscribe(self, nick, subscriber, resourcestr):
+        topics = self.watchtopics(resourcestr)
+        for topic in topics:
+            if not self.watchers.watching(subscriber, topic):
+                raise LockBotException('ERROR, you are not watching %s' % topic,
+                                       resourcestr, self.verb)
+        for topic in topics:
+            self.watchers.remove(subscriber, topic)
+        return "%s: no longer watching %s" % (nick, ', '.join(topics))
+
+    def watch(self, nick, channel, resourcestr):
+        """get private messages when resources or pool:<pool> members are locked, freed or (un)registered"""
+        return (channel, self.subscribe(nick, nick, resourcestr))
+
+    def unwatch(self, nick, channel, resourcestr):
+        """stop watching resources or pools"""
+        return (channel, self.unsubscribe(nick, nick, resourcestr))
+
+    def holdings(self, nick):
+        """(resources nick owns, resources and pools nick waits for)"""
+        owned = sorted(self.holders.owns.get(nick, ()))
+        waiting = sorted(self.graph.waits.get(nick, ()))
+        waiting += [POOLPREFIX + pool for pool, queue in sorted(self.locks.queues.items())
+                    if queue.find(nick)]
+        return owned, waiting
+
+    def involved(self):
+        """nicks holding or waiting for any lock"""
+        nicks = set(self.holders.owns) | set(self.graph.waits)
+        for queue in self.locks.queues.values():
+            nicks.update(request[0] for request in queue.requests)
+        return nicks
+
+    def describeholdings(self, nick):
+        owned, waiting = self.holdings(nick)
+        parts = []
+        if owned:
+            parts.append('holding ' + ', '.join(owned))
+        if waiting:
+            parts.append('waiting for ' + ', '.join(waiting))
+        return ' and '.join(parts)
+
+    def mylocks(self, nick, channel):
+        """list the resources you hold and wait for"""
+        holdings = self.describeholdings(nick)
+        if not holdings:
+            return (channel, "%s: you hold no locks and wait for none" % nick)
+        return (channel, "%s: you are %s" % (nick, holdings))
+
+    def whohas(self, nick, channel, who):
+        """list the resources someone holds and waits for"""
+        who = cleannick(who.strip())
+        holdings = self.describeholdings(who)
+        if not holdings:
+            return (channel, "%s: %s holds no locks and waits for none" % (nick, who))
+        return (channel, "%s: %s is %s" % (nick, who, holdings))
+
+    def unlockall(self, nick, channel, resourcestr):
+        owned, waiting = self.holdings(nick)
+        if not owned and not waiting:
+            raise LockBotException("you hold no locks and wait for none",
+                                   resourcestr, self.verb)
+        # leave pool queues first, so released members don't go to them
+        msgs = [(channel, self.leavepool(nick, pool[len(POOLPREFIX):], resourcestr))
+                for pool in waiting if pool.startswith(POOLPREFIX)]
+        resources = owned + [r for r in waiting if not r.startswith(POOLPREFIX)]
+        if resources:
+            msgs += self.unlock(nick, channel, ','.join(resources))
+        return msgs
 
     def unlock(self, nick, channel, resourcestr):
-        """release the resource lock"""
+        """release the resource lock ("unlock *" releases everything you hold or wait for)"""
+        m = POOLREQUEST.match(resourcestr)
+        if m:
+            return (channel, self.leavepool(nick, m.group(2), resourcestr))
+        if resourcestr.strip() == '*':
+            return self.unlockall(nick, channel, resourcestr)
         resources, multi = self.getlocks(resourcestr)
         # iterate over all resources once to check for errors
         for r in resources:
             l = self.locks[r]
-            if not l.owner:
+            if not l.owner and not l.haswaiter(nick):
                 raise LockBotException("%s is already free" % r, resourcestr,
                                        self.verb)
-            elif l.owner != nick and nick not in l.waiters:
+            elif l.owner != nick and not l.haswaiter(nick):
                 raise LockBotException("DENIED, %s holds the lock on %s" %
                                        (self.locks[r].owner, r),
                                        resourcestr, self.verb)
 
         # all clear, perform unlock
         owned = [r for r in resources if self.locks[r].owner == nick]
-        waiters = [r for r in resources if nick in self.locks[r].waiters]
+        waiters = [r for r in resources if self.locks[r].haswaiter(nick)]
         msgs = []
         if owned:
             multi = len(owned) > 1
@@ -334,26 +1455,57 @@ class LockBotBrain(object):
                                                              'are' if multi else 'is',
                                                              )]
             for r in owned:
-                lock = self.locks[r]
-                lock.owner = ''
-                assignee = lock.popwaiter()
-                if assignee:
-                    msgs += [self._lock(assignee, assignee, r)]
+                msgs += self.handoff(r)
 
         if waiters:
-            multi = len(owned) > 1
-            msgs = ["%s: GAVE UP, no longer waiting for resource%s %s" % (nick,
+            multi = len(waiters) > 1
+            msgs += ["%s: GAVE UP, no longer waiting for resource%s %s" % (nick,
                                                              's' if multi else '',
                                                              ', '.join(waiters)
                                                              )]
             for r in waiters:
                 self.locks[r].popwaiter(nick)
+                self.waitstarted.pop((r, nick), None)
 
         return [(channel, msg) for msg in msgs]
 
+    def leavepool(self, nick, pool, resourcestr):
+        queue = self.locks.queues.get(pool)
+        if not queue or not queue.find(nick):
+            raise LockBotException("you are not waiting for pool:%s" % pool,
+                                   resourcestr, self.verb)
+        queue.remove(nick)
+        return "%s: GAVE UP, no longer waiting for pool:%s" % (nick, pool)
+
+    def renew(self, nick, channel, resourcestr):
+        """extend your lease on a resource (append "for <duration>" to change it)"""
+        resourcestr, options = self.splitOptions(resourcestr)
+        resources, multi = self.getlocks(resourcestr)
+        # iterate over all resources once to check for errors
+        for r in resources:
+            l = self.locks[r]
+            if l.owner != nick:
+                raise LockBotException("DENIED, you do not hold the lock on %s" % r,
+                                       resourcestr, self.verb)
+            elif not l.ttl and 'lease' not in options:
+                raise LockBotException('ERROR: %s has no lease, use "renew %s for <duration>"' %
+                                       (r, r), resourcestr, self.verb)
+
+        # all clear, perform renew
+        for r in resources:
+            self.grantlease(r, options.get('lease') or self.locks[r].ttl)
+        return (channel,
+                "%s: RENEWED, %s" %
+                (nick, ', '.join(["%s for %s" % (r, formatduration(self.locks[r].ttl))
+                                  for r in resources])))
+
     def assignlock(self, nick, channel, assignee, resourcestr):
         """assign a resource lock to someone else other than the caller"""
-        return (channel, self._lock(nick, assignee, resourcestr))
+        assignee = assignee.strip()
+        if not NAME.match(assignee):
+            raise LockBotException('ERROR: invalid nick "%s"' % assignee,
+                                   resourcestr, self.verb)
+        return [(channel, msg) for msg in self._lock(nick, assignee, resourcestr)]
 
     def freelock(self, nick, channel, resourcestr):
         """release a resource lock even if the caller does not hold the lock (USE WITH CAUTION)"""
@@ -374,60 +1526,114 @@ class LockBotBrain(object):
                   ))]
 
         for r in resources:
-            l = self.locks[r]
-            lockowner = l.owner
-            l.owner = ''
+            lockowner = self.locks[r].owner
             msgs += [(channel,
                       "%s: your lock on %s has been released by %s" %
                       (lockowner, r, nick))]
-            assignee = l.popwaiter()
-            if assignee:
-                msgs += [(channel, self._lock(nick, assignee, r))]
+            msgs += [(channel, msg) for msg in self.handoff(r, nick, 'free')]
 
         return msgs
 
     def waitlock(self, nick, channel, resourcestr):
-        """try to take the lock, or get on queue if it is currently locked"""
-        return (channel, self._lock(nick, nick, resourcestr, wait=True))
-
-    def status(self, nick, channel):
-        """list locked resources and their owners"""
-        lockeditems = sorted([item[0] for item in self.locks.items() if item[1].owner])
-        if len(lockeditems) == 0:
-            return (channel, "There are no locked resources")
-        else:
-            messages  = []
-            messages += [(channel, "Status of locked resources:")]
-            for k in lockeditems:
+        """try to take the lock, or get on queue if it is currently locked (append "together" to get all or nothing, "priority N" to queue ahead)"""
+        return [(channel, msg) for msg in self._lock(nick, nick, resourcestr, wait=True)]
+
+    def status(self, nick, channel, selector=None):
+        """list locked resources and their owners, or only those matching a selector like lab1-*"""
+        def render():
+            if selector:
+                names = self.views.select(selector, self.views.locked)
+                if not names:
+                    return ["No locked resources match %s" % selector]
+            else:
+                names = self.views.locked
+            if len(names) == 0:
+                return ["There are no locked resources"]
+            messages = ["Status of locked resources:"]
+            for k in names:
                 l = self.locks[k]
                 msg = "  resource: %s owner: %s" % (k, l.owner)
+                if l.expires:
+                    msg += " until: %s" % time.strftime('%Y-%m-%d %H:%M',
+                                                       time.localtime(l.expires))
                 if l.waiters:
                     msg += " waiters: %s" % ','.join(l.waiters)
-                messages += [(channel, msg)]
-
+                messages.append(msg)
             return messages
 
+        return [(channel, msg) for msg in
+                self.views.render(('status', selector), render)]
+
+    def stats(self, nick, channel, target, window=None):
+        """utilization, hold times and waits of a resource or pool:<pool> over a window like 7d (default 1d)"""
+        span = parseduration(window) if window else 86400
+        if not span:
+            raise LockBotException('ERROR: invalid window "%s", use e.g. 12h or 7d' % window,
+                                   target, self.verb)
+        members = None
+        if target.startswith(POOLPREFIX):
+            pool = self.poolname(target, target)
+            target = POOLPREFIX + pool
+            members = len(self.pools.members.get(pool, ())) or None
+        else:
+            target = self.getlock(target)
+
+        self.journal.flush()
+        end = self.clock.seconds()
+        stats, first = analyze(readevents(self.journal.path, end - span, STATSBYTES),
+                               end - span, end, [target])
+        if target not in stats:
+            return (channel, "%s: nothing recorded for %s in the last %s" %
+                    (nick, target, formatduration(span)))
+        # the journal may not reach back the whole window
+        span = min(span, end - first)
+        return (channel, "%s: %s" % (nick, describe(target, stats[target], span, members)))
+
     def listfree(self, nick, channel):
         """list unlocked resources"""
-        freeitems = [item[0] for item in self.locks.items() if not item[1].owner]
-        if len(freeitems) == 0:
-            return (channel, "There are no unlocked resources")
-        else:
-            return (channel, "Unlocked resources: " + ', '.join(sorted(freeitems)))
+        def render():
+            if len(self.views.free) == 0:
+                return "There are no unlocked resources"
+            return "Unlocked resources: " + ', '.join(self.views.free)
+
+        return (channel, self.views.render('listfree', render))
 
     def list(self, nick, channel):
         """list all registered resources"""
-        if len(self.locks.keys()) == 0:
-            return (channel, "There are no registered resources")
-        else:
-            return (channel, "List of registered resources: %s" %
-                    ', '.join(sorted(self.locks.keys())))
+        def render():
+            if len(self.views.all) == 0:
+                return "There are no registered resources"
+            return "List of registered resources: %s" % ', '.join(self.views.all)
+
+        return (channel, self.views.render('list', render))
+
+    def listpools(self, nick, channel):
+        """list pools with their free members and queued requests"""
+        def render():
+            if not self.pools.members:
+                return ["There are no pools"]
+            messages = ["Pools:"]
+            for pool in sorted(self.pools.members):
+                msg = "  pool: %s free: %d/%d" % (pool, len(self.pools.free[pool]),
+                                                 len(self.pools.members[pool]))
+                queue = self.locks.queues.get(pool)
+                if queue and queue.requests:
+                    msg += " waiters: %s" % ','.join('%s(%d)' % (nick, n)
+                                                     for nick, n, _, _ in queue.requests)
+                messages.append(msg)
+            return messages
+
+        return [(channel, msg) for msg in self.views.render('listpools', render)]
 
     def help(self, nick, channel):
         """display this help message"""
 
         def getCmdArguments(handler):
-            return inspect.getargspec(handler)[0][3:]
+            # arguments with a default are optional
+            args, _, _, defaults = inspect.getargspec(handler)
+            optional = len(args) - len(defaults or ())
+            return ["[%s]" % arg if i >= optional else "<%s>" % arg
+                    for i, arg in enumerate(args) if i >= 3]
 
         helpTuples = []
         rules = self.getRules()
@@ -437,8 +1643,7 @@ class LockBotBrain(object):
                 continue
             processedHandlers.add(handler)
             helpTuples.append((handler.__name__ + ' ' +
-                               ' '.join(["<%s>" % arg
-                                         for arg in getCmdArguments(handler)]),
+                               ' '.join(getCmdArguments(handler)),
                                handler.__doc__
                                ))
             if handler.__name__ == 'help':
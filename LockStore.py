@@ -0,0 +1,260 @@
+import os
+import zlib
+import fcntl
+import marshal
+import dumbdbm
+
+# Version 1 snapshots hold the table as records like the log, version 2 as
+# a marshalled dict, which loads without parsing a record at a time.
+SNAPSHOT_MAGIC = 'LOCKSNAP 2\n'
+SNAPSHOT_V1 = 'LOCKSNAP 1\n'
+
+def lockdatabase(path):
+    """take the lock keeping other processes off the database at path;
+    it is held until the returned file is closed"""
+    lockfile = open(path + '.lock', 'a')
+    try:
+        fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        lockfile.close()
+        raise IOError('database %s is in use by another process' % path)
+    return lockfile
+
+class DumbDBMStore(object):
+    def __init__(self, path, exclusive=True):
+        self.lockfile = lockdatabase(path) if exclusive else None
+        self.db = dumbdbm.open(path)
+
+    def load(self):
+        return [(intern(k), v) for k, v in self.db.items()]
+
+    def commit(self, changes):
+        for name, lockstr in changes:
+            if lockstr is not None:
+                self.db[name] = lockstr
+            elif name in self.db:
+                del self.db[name]
+        self.db.sync()
+
+    def close(self):
+        self.db.close()
+        if self.lockfile:
+            self.lockfile.close()
+
+def encoderecords(changes):
+    # 's' sets the state of a resource (registering it if needed), 'd'
+    # drops it. Fields are netstrings, so names may hold any byte.
+    parts = []
+    for name, lockstr in changes:
+        if lockstr is None:
+            parts.append('d%d:%s' % (len(name), name))
+        else:
+            parts.append('s%d:%s%d:%s' % (len(name), name, len(lockstr), lockstr))
+    return ''.join(parts)
+
+def decoderecords(payload):
+    pos = 0
+    while pos < len(payload):
+        op = payload[pos]
+        fields = []
+        pos += 1
+        for _ in range(2 if op == 's' else 1):
+            colon = payload.index(':', pos)
+            size = int(payload[pos:colon])
+            fields.append(payload[colon + 1:colon + 1 + size])
+            pos = colon + 1 + size
+        if op == 's':
+            yield fields[0], fields[1]
+        elif op == 'd':
+            yield fields[0], None
+        else:
+            raise ValueError('unknown record type %r' % op)
+
+def frame(payload):
+    return '%08x %d\n%s\n' % (zlib.crc32(payload) & 0xffffffff, len(payload), payload)
+
+def readframes(f):
+    """yield (offset past frame, payload) for every intact frame in f"""
+    while True:
+        header = f.readline()
+        if not header.endswith('\n'):
+            return
+        try:
+            crc, size = header.split()
+            crc, size = int(crc, 16), int(size)
+        except ValueError:
+            return
+        payload = f.read(size)
+        if len(payload) != size or f.read(1) != '\n':
+            return
+        if zlib.crc32(payload) & 0xffffffff != crc:
+            return
+        yield f.tell(), payload
+
+def fsyncpolicy(text):
+    """seconds between log fsyncs for an fsync setting: "always" syncs
+    every commit (0), "never" leaves it to the OS (None), a number syncs
+    at most that often"""
+    text = str(text).strip().lower()
+    if text == 'always':
+        return 0
+    if text == 'never':
+        return None
+    try:
+        seconds = float(text)
+    except ValueError:
+        seconds = -1
+    if seconds < 0:
+        raise ValueError('fsync must be always, never or seconds, not "%s"' % text)
+    return seconds
+
+class LogStore(object):
+    """append-only operation log with periodic snapshots
+
+    Every commit appends one checksummed frame to <path>.log. With fsync
+    0 it is synced once per commit, with fsync None never, otherwise at
+    most every fsync seconds, which batches the syncs of busy periods at
+    the risk of losing the commits of the last interval on a power loss;
+    a commit left unsynced is synced by a timer on clock (the reactor by
+    default) once the interval is over.
+    When the log outgrows compactbytes, and on a clean close, the table
+    is written to <path>.snap and the log is truncated. On open, replay
+    stops at the first torn or corrupt frame and the log is cut back to
+    that point. An flock on <path>.lock keeps a second process off the
+    database.
+    """
+    def __init__(self, path, compactbytes=4 * 1024 * 1024, fsync=0, clock=None):
+        self.snappath = path + '.snap'
+        self.logpath = path + '.log'
+        self.compactbytes = compactbytes
+        self.fsync = fsync
+        self.clock = clock
+        self.synced = None
+        self.pendingsync = None
+        self.table = {}
+        self.lockfile = lockdatabase(path)
+
+        if not os.path.exists(self.snappath) and \
+           not os.path.exists(self.logpath) and \
+           os.path.exists(path + '.dir'):
+            # first start after switching from the dumbdbm backend
+            legacy = DumbDBMStore(path, exclusive=False)
+            self.table = dict(legacy.load())
+            legacy.close()
+            self.snapshot()
+
+        self.recover()
+        self.log = open(self.logpath, 'ab')
+
+    def recover(self):
+        if os.path.exists(self.snappath):
+            with open(self.snappath, 'rb') as f:
+                magic = f.readline()
+                if magic not in (SNAPSHOT_MAGIC, SNAPSHOT_V1):
+                    raise IOError('%s is not a lock snapshot' % self.snappath)
+                intact = False
+                for _, payload in readframes(f):
+                    intact = True
+                    if magic == SNAPSHOT_V1:
+                        self.table = dict((intern(k), v) for k, v in decoderecords(payload))
+                    else:
+                        # names were interned when dumped, marshal interns them again
+                        self.table = marshal.loads(payload)
+                # carrying on with an empty table would compact it over
+                # the snapshot on the next commit
+                if not intact:
+                    raise IOError('%s is torn or corrupt' % self.snappath)
+
+        end = 0
+        if os.path.exists(self.logpath):
+            with open(self.logpath, 'rb') as f:
+                for end, payload in readframes(f):
+                    self.apply(decoderecords(payload))
+            if end != os.path.getsize(self.logpath):
+                with open(self.logpath, 'r+b') as f:
+                    f.truncate(end)
+
+    def apply(self, changes):
+        for name, lockstr in changes:
+            if lockstr is None:
+                self.table.pop(name, None)
+            else:
+                self.table[intern(name)] = lockstr
+
+    def load(self):
+        return self.table.items()
+
+    def commit(self, changes):
+        changes = list(changes)
+        if not changes:
+            return
+        self.apply(changes)
+        self.log.write(frame(encoderecords(changes)))
+        self.log.flush()
+        if self.fsync == 0:
+            os.fsync(self.log.fileno())
+        elif self.fsync is not None:
+            self.schedulesync()
+        if self.log.tell() >= self.compactbytes:
+            self.compact()
+
+    def schedulesync(self):
+        if self.clock is None:
+            from twisted.internet import reactor
+            self.clock = reactor
+        if self.pendingsync:
+            return
+        now = self.clock.seconds()
+        if self.synced is None or now - self.synced >= self.fsync:
+            self.sync()
+        else:
+            self.pendingsync = self.clock.callLater(self.synced + self.fsync - now,
+                                                    self.sync)
+
+    def sync(self):
+        if self.pendingsync and self.pendingsync.active():
+            self.pendingsync.cancel()
+        self.pendingsync = None
+        os.fsync(self.log.fileno())
+        self.synced = self.clock.seconds()
+
+    def compact(self):
+        self.snapshot()
+        self.log.seek(0)
+        self.log.truncate()
+        if self.fsync is not None:
+            os.fsync(self.log.fileno())
+
+    def snapshot(self):
+        tmppath = self.snappath + '.tmp'
+        with open(tmppath, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(frame(marshal.dumps(self.table)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmppath, self.snappath)
+        dirfd = os.open(os.path.dirname(self.snappath) or '.', os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+    def close(self):
+        if self.pendingsync and self.pendingsync.active():
+            self.pendingsync.cancel()
+        if os.path.getsize(self.logpath):
+            self.compact()
+        self.log.close()
+        self.lockfile.close()
+
+STORES = {
+    'dumbdbm': DumbDBMStore,
+    'log':     LogStore,
+}
+
+def openstore(kind, path, options=None):
+    """open the store at path; options are keyword arguments of the backend"""
+    if kind not in STORES:
+        raise ValueError('unknown storage backend "%s" (expected one of %s)' %
+                         (kind, ', '.join(sorted(STORES))))
+    return STORES[kind](path, **(options or {}))
@@ -1,5 +1,54 @@
+import Queue
+import atexit
 import logging
 import logging.handlers
+import threading
+
+class QueueWriter(logging.Handler):
+    """hands records to a background thread that writes them to target
+
+    emit() never blocks: when the bounded queue is full the record is
+    dropped and counted, and the writer reports the count once it catches
+    up. Messages are only formatted on the writer thread.
+    """
+    def __init__(self, target, maxsize=10000):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue = Queue.Queue(maxsize)
+        self.dropped = 0
+        self.reported = 0
+        self.thread = threading.Thread(target=self.run, name='lockbot-logger')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            dropped = self.dropped
+            if dropped != self.reported:
+                self.target.handle(logging.makeLogRecord({
+                    'levelno': logging.WARNING,
+                    'levelname': 'WARNING',
+                    'msg': '[lockbot] warning: log queue full, dropped %d messages',
+                    'args': (dropped - self.reported,)}))
+                self.reported = dropped
+            self.target.handle(record)
+
+    def close(self, timeout=1.0):
+        try:
+            self.queue.put(None, timeout=timeout)
+        except Queue.Full:
+            pass
+        self.thread.join(timeout)
+        logging.Handler.close(self)
 
 class Logger(object):
 
@@ -8,21 +57,36 @@ class Logger(object):
         if not cls._instance:
             cls._instance = super(Logger, cls).__new__(cls, *args, **kwargs)
         return cls._instance
-        
+
     def __init__(self):
+        if hasattr(self, 'logger'):
+            return
         self.logger = logging.getLogger()
-        self.logger.setLevel(logging.DEBUG)
+        self.logger.setLevel(logging.INFO)
 
         handler = logging.handlers.SysLogHandler(address='/dev/log')
+        self.writer = QueueWriter(handler)
+
+        self.logger.addHandler(self.writer)
+        atexit.register(self.writer.close)
+
+    def setLevel(self, level):
+        """set the level by name, e.g. 'debug' or 'info'"""
+        self.logger.setLevel(logging.getLevelName(level.upper()))
+
+    def getLevel(self):
+        return logging.getLevelName(self.logger.level).lower()
 
-        self.logger.addHandler(handler)
+    def dropped(self):
+        return self.writer.dropped
 
-    def debug(self, msg):
-        self.logger.debug('[lockbot] debug: ' + msg)
+    # Arguments are only interpolated into msg if the level is enabled.
+    def debug(self, msg, *args):
+        self.logger.debug('[lockbot] debug: ' + msg, *args)
 
-    def critical(self, msg):
-        self.logger.critical('[lockbot] critical: ' + msg)
+    def critical(self, msg, *args):
+        self.logger.critical('[lockbot] critical: ' + msg, *args)
 
-    def info(self, msg):
-        self.logger.info('[lockbot] info: ' + msg)
+    def info(self, msg, *args):
+        self.logger.info('[lockbot] info: ' + msg, *args)
 
@@ -1,6 +1,15 @@
-import sys, ConfigParser
-from twisted.internet import reactor, ssl
+import time
+started = time.time()
+
+import sys, signal, ConfigParser
+from twisted.internet import reactor
 from LockBot import LockBotFactory
+from LockAPI import LockAPIFactory
+from Replication import ReplicationServer, Standby
+from Namespaces import ircfold
+import Logger
+import Metrics
+import LockStore
 
 if __name__ == "__main__":
     if len(sys.argv) != 2:
@@ -11,35 +20,131 @@ if __name__ == "__main__":
 
     section='lockbot'
     defaultcfg = {'usessl'  : 'no',
-                  'nickname': 'lockbot'}
+                  'nickname': 'lockbot',
+                  'storage' : 'log',
+                  'linerate': '0.5',
+                  'lineburst': '5',
+                  'apiport' : '',
+                  'apisocket': '',
+                  'loglevel': 'info',
+                  'metricsport': '',
+                  'idletime': '3600',
+                  'replicationport': '',
+                  'follow': '',
+                  'failovertimeout': '5',
+                  'releaseonquit': 'no',
+                  'compactbytes': '4194304',
+                  'fsync': 'always'}
 
     cfg = ConfigParser.RawConfigParser(defaultcfg)
     cfg.read(cfgpath)
     
     usessl = cfg.getboolean(section, 'usessl')
 
-    server   = cfg.get(section, 'server')
+    ircserver = cfg.get(section, 'server')
     port     = cfg.getint(section, 'port')
-    channel  = cfg.get(section, 'channel')
+    channels = [ircfold('#' + c.strip()) for c in cfg.get(section, 'channel').split(',')]
     nickname = cfg.get(section, 'nickname')
     dbdir    = cfg.get(section, 'dbdir')
     password = cfg.get(section, 'password')
+    storage  = cfg.get(section, 'storage')
+    linerate = cfg.getfloat(section, 'linerate')
+    lineburst = cfg.getint(section, 'lineburst')
+    apiport  = cfg.get(section, 'apiport')
+    apisocket = cfg.get(section, 'apisocket')
+    loglevel = cfg.get(section, 'loglevel')
+    metricsport = cfg.get(section, 'metricsport')
+    idletime = cfg.getint(section, 'idletime')
+    replicationport = cfg.get(section, 'replicationport')
+    follow = cfg.get(section, 'follow')
+    failovertimeout = cfg.getfloat(section, 'failovertimeout')
+    releaseonquit = cfg.getboolean(section, 'releaseonquit')
+    if linerate <= 0 or lineburst < 1:
+        sys.stderr.write("linerate must be above 0 and lineburst at least 1\n")
+        sys.exit(1)
+    storeoptions = {}
+    if storage == 'log':
+        storeoptions = {'compactbytes': cfg.getint(section, 'compactbytes'),
+                        'fsync': LockStore.fsyncpolicy(cfg.get(section, 'fsync'))}
+
+    # SIGUSR1 toggles debug logging on a running bot, back to the
+    # configured level, or to info if that is debug itself
+    logger = Logger.Logger()
+    logger.setLevel(loglevel)
+    def toggledebug(signum, frame):
+        if logger.getLevel() != 'debug':
+            logger.setLevel('debug')
+        else:
+            logger.setLevel(loglevel if loglevel.lower() != 'debug' else 'info')
+    signal.signal(signal.SIGUSR1, toggledebug)
+    logger.debug("imports done %.3fs after start", time.time() - started)
+
+    def stepdown(reason):
+        # a newer instance serves the channels now, don't compete with it
+        reactor.stop()
+
+    def start(replicas=None, term=0):
+        lockbotfactory = LockBotFactory(channels,
+                                        nickname,
+                                        dbdir,
+                                        password=password,
+                                        storage=storage,
+                                        linerate=linerate,
+                                        lineburst=lineburst,
+                                        idletime=idletime,
+                                        started=started,
+                                        releaseonquit=releaseonquit,
+                                        storeoptions=storeoptions)
+        reactor.addSystemEventTrigger('before', 'shutdown',
+                                      lockbotfactory.brains.close)
+        # state handed over by the instance this one was standing by for
+        for channel, entries in sorted((replicas or {}).items()):
+            if ircfold(channel) in channels:
+                lockbotfactory.brains.restore(channel, entries)
+
+        connectfn = reactor.connectTCP
+        connectargs = []
+        connectargs.append(ircserver)
+        connectargs.append(port)
+        connectargs.append(lockbotfactory)
+        if usessl:
+            from twisted.internet import ssl
+            connectfn = reactor.connectSSL
+            connectargs.append(ssl.ClientContextFactory())
+
+        connectargs = tuple(connectargs)
+
+        # local JSON API, sharing the IRC bot's brains
+        if apiport or apisocket:
+            apifactory = LockAPIFactory(lockbotfactory.brains)
+            if apiport:
+                reactor.listenTCP(int(apiport), apifactory, interface='127.0.0.1')
+            if apisocket:
+                reactor.listenUNIX(apisocket, apifactory)
 
-    lockbotfactory = LockBotFactory('#' + channel,
-                                    nickname,
-                                    dbdir,
-                                    password=password)
+        # Prometheus metrics over HTTP
+        if metricsport:
+            from twisted.web.server import Site
+            Metrics.REGISTRY.gauge('lockbot_log_dropped',
+                                   'log records dropped because the log queue was full',
+                                   logger.dropped)
+            reactor.listenTCP(int(metricsport), Site(Metrics.MetricsPage()),
+                              interface='127.0.0.1')
 
-    connectfn = reactor.connectTCP
-    connectargs = []
-    connectargs.append(server)
-    connectargs.append(port)
-    connectargs.append(lockbotfactory)
-    if usessl:
-        connectfn = reactor.connectSSL
-        connectargs.append(ssl.ClientContextFactory())
+        # stream every commit to standby instances
+        if replicationport:
+            reactor.listenTCP(int(replicationport),
+                              ReplicationServer(lockbotfactory.brains, stepdown, term,
+                                                timeout=failovertimeout),
+                              interface='127.0.0.1')
 
-    connectargs = tuple(connectargs)
+        connectfn(*connectargs)
+        logger.debug("started %.3fs after start", time.time() - started)
 
-    connectfn(*connectargs)
+    if follow:
+        followhost, followport = follow.rsplit(':', 1)
+        reactor.connectTCP(followhost, int(followport),
+                           Standby(start, timeout=failovertimeout))
+    else:
+        start()
     reactor.run()
@@ -0,0 +1,143 @@
+import time
+import bisect
+
+from twisted.web import resource
+
+BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5,
+           10, 30, 60, 300, 900, 3600, 14400, 86400)
+
+def formatlabels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                                                  .replace('"', '\\"')
+                                                  .replace('\n', '\\n'))
+                             for k, v in labels)
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def samples(self):
+        return [(self.name, labels, value)
+                for labels, value in sorted(self.values.items())]
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn=None):
+        super(Gauge, self).__init__(name, help)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def samples(self):
+        if not self.fn:
+            return super(Gauge, self).samples()
+        # fn returns either a value or a list of (labels, value)
+        value = self.fn()
+        if isinstance(value, list):
+            return [(self.name, self.key(labels), v) for labels, v in value]
+        return [(self.name, (), value)]
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=BUCKETS):
+        super(Histogram, self).__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        if key not in self.values:
+            self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+        counts = self.values[key]
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            counts[0][i] += 1
+        counts[1] += 1
+        counts[2] += value
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def samples(self):
+        samples = []
+        for labels, (counts, count, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                samples.append((self.name + '_bucket', labels + (('le', repr(bound)),),
+                                cumulative))
+            samples.append((self.name + '_bucket', labels + (('le', '+Inf'),), count))
+            samples.append((self.name + '_count', labels, count))
+            samples.append((self.name + '_sum', labels, total))
+        return samples
+
+class Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help))
+
+    def gauge(self, name, help, fn=None):
+        return self.register(Gauge(name, help, fn))
+
+    def histogram(self, name, help, buckets=BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def render(self):
+        """the registry in the Prometheus text exposition format"""
+        lines = []
+        for name in sorted(self.metrics):
+            metric = self.metrics[name]
+            lines.append('# HELP %s %s' % (name, metric.help))
+            lines.append('# TYPE %s %s' % (name, metric.kind))
+            for sample, labels, value in metric.samples():
+                lines.append('%s%s %s' % (sample, formatlabels(labels), repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+class MetricsPage(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, registry=REGISTRY):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'text/plain; version=0.0.4')
+        return self.registry.render()
@@ -0,0 +1,190 @@
+from itertools import repeat
+from collections import OrderedDict
+
+# Fuzzy matching accepts the best Levenshtein.ratio over all registered
+# names when it is at least MINRATIO and unique.
+MINRATIO = 0.5
+
+# Names scored from the rarest posting lists before pruning, to raise the
+# bar the remaining names have to clear.
+SEEDBUDGET = 2048
+
+CACHESIZE = 1024
+
+def bigrams(name):
+    padded = '\0' + name + '\1'
+    return [padded[i:i + 2] for i in range(len(padded) - 1)]
+
+def chartokens(name):
+    # (c, j) stands for "holds at least j copies of c", so the number of
+    # tokens two names share is their character multiset overlap
+    seen = {}
+    tokens = []
+    for c in name:
+        seen[c] = seen.get(c, 0) + 1
+        tokens.append((c, seen[c]))
+    return tokens
+
+def minlcs(ratio, total, strict=False):
+    """smallest LCS for which Levenshtein.ratio (2 * LCS / total) reaches
+    ratio, or exceeds it if strict"""
+    def enough(lcs):
+        r = 2.0 * lcs / total
+        return r > ratio if strict else r >= ratio
+    lcs = int(ratio * total / 2)
+    while lcs > 0 and enough(lcs - 1):
+        lcs -= 1
+    while not enough(lcs):
+        lcs += 1
+    return lcs
+
+def prefixfilter(postings, counts, misses):
+    """posting lists one of which holds every name missing at most misses
+    of the query tokens, or None when no such prefix exists"""
+    chosen = []
+    covered = 0
+    for token in sorted(counts, key=lambda t: len(postings.get(t, ()))):
+        chosen.append(postings.get(token, ()))
+        covered += counts[token]
+        if covered > misses:
+            return chosen
+    return None
+
+class NameIndex(object):
+    """token index resolving mistyped resource names
+
+    closest() returns exactly what scoring Levenshtein.ratio against every
+    registered name would. Levenshtein.ratio is 2 * LCS / (la + lb); the
+    LCS is bounded both by the characters two names share and, since each
+    dropped character breaks at most one adjacent pair, by the bigrams they
+    share. Once a good match is known, only names sharing enough tokens to
+    tie it are scored, or to beat it once it is tied, as a tie is no match.
+
+    The token indexes are only built, and Levenshtein only imported, by the
+    first lookup of a name that is not registered; most runs never mistype
+    one.
+    """
+    def __init__(self, names=()):
+        self.names = set(names)
+        self.grams = None
+        self.chars = None
+        self.bylength = None
+        self.cache = OrderedDict()
+
+    def build(self):
+        self.grams = {}
+        self.chars = {}
+        self.bylength = {}
+        for name in self.names:
+            self.index(name)
+
+    def add(self, name):
+        self.names.add(name)
+        if self.grams is not None:
+            self.index(name)
+        self.cache.clear()
+
+    def index(self, name):
+        for gram in set(bigrams(name)):
+            self.grams.setdefault(gram, set()).add(name)
+        for token in chartokens(name):
+            self.chars.setdefault(token, set()).add(name)
+        self.bylength.setdefault(len(name), set()).add(name)
+
+    def remove(self, name):
+        self.names.discard(name)
+        self.cache.clear()
+        if self.grams is None:
+            return
+        for index, tokens in ((self.grams, set(bigrams(name))),
+                              (self.chars, chartokens(name)),
+                              (self.bylength, [len(name)])):
+            for token in tokens:
+                index[token].discard(name)
+                if not index[token]:
+                    del index[token]
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def closest(self, name):
+        if name in self:
+            return name
+        if name in self.cache:
+            match = self.cache.pop(name)
+        else:
+            match = self.search(name)
+            if len(self.cache) >= CACHESIZE:
+                self.cache.popitem(last=False)
+        self.cache[name] = match
+        return match
+
+    def search(self, name):
+        import Levenshtein
+        if self.grams is None:
+            self.build()
+        la = len(name)
+        grams = {}
+        for gram in bigrams(name):
+            grams[gram] = grams.get(gram, 0) + 1
+        chars = dict((token, 1) for token in chartokens(name))
+
+        state = {'best': -1.0, 'ties': 0, 'match': name}
+        scored = set()
+        def score(candidates):
+            fresh = list(set(candidates).difference(scored))
+            if not fresh:
+                return
+            scored.update(fresh)
+            ratios = map(Levenshtein.ratio, repeat(name, len(fresh)), fresh)
+            r = max(ratios)
+            if r > state['best']:
+                state.update(best=r, ties=ratios.count(r), match=fresh[ratios.index(r)])
+            elif r == state['best']:
+                state['ties'] += ratios.count(r)
+
+        # seed with the names sharing the rarest bigrams, and with those
+        # sharing as many of them as any name does
+        rarest = sorted(grams, key=lambda g: len(self.grams.get(g, ())))
+        seeded = 0
+        for gram in rarest:
+            postings = self.grams.get(gram, ())
+            if seeded + len(postings) > SEEDBUDGET:
+                break
+            seeded += len(postings)
+            score(postings)
+        seeds = None
+        for gram in rarest:
+            postings = self.grams.get(gram)
+            if not postings:
+                continue
+            narrowed = postings if seeds is None else seeds & postings
+            if not narrowed:
+                break
+            seeds = narrowed
+        if seeds and len(seeds) <= SEEDBUDGET:
+            score(seeds)
+
+        # every name that could still change the result: one reaching the
+        # best ratio so far, or once that is tied and so no match, one
+        # beating it
+        bar = max(state['best'], MINRATIO)
+        strict = state['ties'] > 1 and state['best'] >= MINRATIO
+        lengths = [lb for lb in self.bylength
+                   if minlcs(bar, la + lb, strict) <= min(la, lb)]
+        if lengths:
+            lcs = min(minlcs(bar, la + lb, strict) for lb in lengths)
+            shared = min(3 * minlcs(bar, la + lb, strict) + 1 - la - lb for lb in lengths)
+            filters = [f for f in (prefixfilter(self.grams, grams, len(bigrams(name)) - shared),
+                                   prefixfilter(self.chars, chars, la - lcs))
+                       if f is not None]
+            if filters:
+                postings = min(filters, key=lambda f: sum(len(p) for p in f))
+            else:
+                postings = [self.bylength[lb] for lb in lengths]
+            for candidates in postings:
+                score(candidates)
+
+        if state['best'] < MINRATIO or state['ties'] > 1:
+            return name
+        return state['match']
@@ -0,0 +1,192 @@
+import os
+import re
+import string
+from collections import OrderedDict
+
+from twisted.internet import task
+
+from LockBotBrain import LockBotBrain, GAUGES, DBNAME, JOURNALNAME
+import LockStore
+import Logger
+import Metrics
+
+# RFC 1459 casemapping: besides letters, {}|^ are the lower case of []\~
+CASEFOLD = string.maketrans('[]\\~', '{}|^')
+
+# the files of the first namespace, which lives in dbdir itself
+RESERVED = (DBNAME, JOURNALNAME)
+
+UNSAFE = re.compile(r'[^a-z0-9_-]')
+
+def ircfold(name):
+    """the form of a channel name that compares as IRC servers do"""
+    return name.lower().translate(CASEFOLD)
+
+def dirname(channel):
+    """directory name of a channel's namespace inside dbdir; anything but
+    letters, digits, _ and - is %-encoded, so no name can leave dbdir"""
+    name = UNSAFE.sub(lambda m: '%%%02x' % ord(m.group()), ircfold(channel)[1:])
+    if not name or name in RESERVED:
+        # a '%' without two hex digits after it is never made by encoding
+        name = '%' + name
+    return name
+
+class BrainPool(object):
+    """lock namespaces of a bot serving several channels
+
+    Every channel has its own brain and database directory; the first
+    channel keeps using dbdir itself, the others get dbdir/<channel>,
+    see dirname(). Channel names are compared casefolded, see ircfold().
+    Brains are opened on first use and closed again once idle for idletime
+    seconds, unless they have leases running or are pinned by blocked API
+    requests.
+    """
+    def __init__(self, channels, nickname, dbdir, storage='log', clock=None,
+                 idletime=3600, storeoptions=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.channels = [ircfold(c) for c in channels]
+        self.nickname = nickname
+        self.dbdir = dbdir
+        self.storage = storage
+        self.storeoptions = storeoptions
+        self.clock = clock
+        self.idletime = idletime
+        self.brains = OrderedDict()
+        self.lastused = {}
+        # channel -> nicks holding or waiting for locks in it, for namespaces
+        # not loaded; only a loaded brain changes them
+        self.involved = {}
+        self.announcers = []
+        self.commitlisteners = []
+        self.logger = Logger.Logger()
+
+        for name, help, fn in GAUGES:
+            Metrics.REGISTRY.gauge(name, help, self.gauge(fn))
+
+        self.evictor = task.LoopingCall(self.evictidle)
+        self.evictor.clock = clock
+        self.evictor.start(max(idletime / 4.0, 1), now=False)
+
+    def gauge(self, fn):
+        return lambda: [({'namespace': channel}, fn(brain))
+                        for channel, brain in self.brains.items()]
+
+    @property
+    def primary(self):
+        return self.channels[0]
+
+    def dbdirfor(self, channel):
+        if channel == self.primary:
+            return self.dbdir
+        if not os.path.isdir(self.dbdir):
+            os.mkdir(self.dbdir)
+        path = os.path.join(self.dbdir, dirname(channel))
+        if not os.path.exists(path):
+            self.migrate(channel, path)
+        return path
+
+    def migrate(self, channel, path):
+        # namespaces used to live in dbdir/<channel as configured, without #>
+        legacy = channel.lstrip('#&')
+        taken = set(dirname(c) for c in self.channels)
+        for name in os.listdir(self.dbdir):
+            if (name not in taken and ircfold(name) == legacy and
+                    os.path.isdir(os.path.join(self.dbdir, name))):
+                self.logger.info("moving namespace %s from %s to %s", channel, name, path)
+                os.rename(os.path.join(self.dbdir, name), path)
+                return
+
+    def get(self, channel=None):
+        """the brain for channel, the primary namespace if None"""
+        channel = ircfold(channel or self.primary)
+        if channel not in self.channels:
+            raise KeyError('unknown namespace %s' % channel)
+        self.lastused[channel] = self.clock.seconds()
+        if channel not in self.brains:
+            self.logger.info("loading namespace %s", channel)
+            brain = LockBotBrain(self.nickname, self.dbdirfor(channel),
+                                 self.storage, clock=self.clock,
+                                 storeoptions=self.storeoptions)
+            brain.announcers.append(
+                lambda messages, urgent: self.announce(channel, messages, urgent))
+            brain.locks.commitlisteners.append(
+                lambda changes: self.committed(channel, brain, changes))
+            self.brains[channel] = brain
+            self.involved.pop(channel, None)
+        return self.brains[channel]
+
+    def involves(self, channel, nick):
+        """whether nick holds or waits for locks in channel, which is not
+        loaded to tell"""
+        channel = ircfold(channel)
+        if channel in self.brains:
+            return any(self.brains[channel].holdings(nick))
+        if channel not in self.involved:
+            # every stored entry, lock or pool queue, is a comma separated
+            # list of "nick;attributes", an unlocked resource's starting
+            # with an empty nick
+            self.involved[channel] = set(item.split(';', 1)[0]
+                                         for _, entry in self.stored(channel)
+                                         for item in entry.split(','))
+            self.involved[channel].discard('')
+        return nick in self.involved[channel]
+
+    def snapshot(self, channel):
+        """every entry of channel, read from the store unless it is loaded"""
+        channel = ircfold(channel)
+        if channel in self.brains:
+            return self.brains[channel].locks.dump()
+        return self.stored(channel)
+
+    def stored(self, channel):
+        dbdir = self.dbdirfor(channel)
+        if not os.path.isdir(dbdir):
+            return []
+        store = LockStore.openstore(self.storage, os.path.join(dbdir, DBNAME),
+                                    self.storeoptions)
+        entries = list(store.load())
+        store.close()
+        return entries
+
+    def restore(self, channel, entries):
+        """replace the stored locks of channel with entries"""
+        channel = ircfold(channel)
+        if channel in self.brains:
+            self.brains.pop(channel).close()
+        self.involved.pop(channel, None)
+        dbdir = self.dbdirfor(channel)
+        if not os.path.isdir(dbdir):
+            os.mkdir(dbdir)
+        store = LockStore.openstore(self.storage, os.path.join(dbdir, DBNAME),
+                                    self.storeoptions)
+        entries = dict(entries)
+        changes = [(name, None) for name, _ in store.load() if name not in entries]
+        store.commit(changes + entries.items())
+        store.close()
+
+    def announce(self, channel, messages, urgent=False):
+        messages = [(target or channel, message) for target, message in messages]
+        for announcer in self.announcers:
+            announcer(messages, urgent)
+
+    def committed(self, channel, brain, changes):
+        for listener in self.commitlisteners:
+            listener(channel, brain, changes)
+
+    def close(self):
+        """commit and close every loaded namespace"""
+        self.evictor.stop()
+        for channel, brain in self.brains.items():
+            brain.close()
+        self.brains.clear()
+
+    def evictidle(self):
+        now = self.clock.seconds()
+        for channel, brain in list(self.brains.items()):
+            if now - self.lastused[channel] < self.idletime or not brain.idle():
+                continue
+            self.logger.info("evicting idle namespace %s", channel)
+            self.involved[channel] = brain.involved()
+            brain.close()
+            del self.brains[channel]
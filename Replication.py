@@ -0,0 +1,236 @@
+from twisted.internet import protocol, task
+from twisted.protocols import basic
+
+from LockStore import encoderecords, decoderecords
+import Logger
+
+# Messages are netstrings holding "<op> <argument>\n" and the changes in
+# the store's record encoding. From the active instance:
+#   hello     its term, sent when a standby connects
+#   snapshot  all entries of a namespace, sent after hello
+#   commit    the changes of one commit to a namespace, as handed to the store
+#   ping      heartbeat, no argument or changes
+# From the standby:
+#   follow    the seconds of silence after which it takes over
+#   fence     the term it takes over with; the active instance steps down
+#
+# Terms number the instances that were active one after the other. A
+# standby takes over with the term after the one it followed, and an
+# instance told of a later term than its own stops serving.
+
+def message(op, argument='', changes=()):
+    return '%s %s\n%s' % (op, argument, encoderecords(changes))
+
+def parse(string):
+    header, payload = string.split('\n', 1)
+    op, argument = header.split(' ', 1)
+    return op, argument, payload
+
+class ReplicationSender(basic.NetstringReceiver):
+    def connectionMade(self):
+        factory = self.factory
+        factory.logger.info("standby connected from %s", self.transport.getPeer())
+        # until it says, assume the standby waits as long as the default
+        self.timeout = None
+        self.send('hello', factory.term)
+        for channel in factory.brains.channels:
+            self.send('snapshot', channel, factory.brains.snapshot(channel))
+        factory.standbys.append(self)
+
+    def connectionLost(self, reason):
+        if self in self.factory.standbys:
+            self.factory.standbys.remove(self)
+
+    def send(self, op, argument='', changes=()):
+        self.sendString(message(op, argument, changes))
+
+    def stringReceived(self, string):
+        op, argument, _ = parse(string)
+        if op == 'follow':
+            self.timeout = float(argument)
+        elif op == 'fence':
+            self.factory.fenced(int(argument))
+
+class ReplicationServer(protocol.ServerFactory):
+    """streams every committed change of the brains to standby instances
+
+    stepdown(reason) is called, once, when this instance has to stop
+    serving: a standby fenced it with a later term, or the reactor stalled
+    for longer than a following standby waits before taking over. Timers
+    run before pending I/O is read, so a stall is noticed before any
+    command that queued up during it is served.
+    """
+    protocol = ReplicationSender
+
+    def __init__(self, brains, stepdown, term=0, interval=1.0, timeout=5.0, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.brains = brains
+        self.stepdown = stepdown
+        self.term = term
+        self.interval = interval
+        self.timeout = timeout
+        self.clock = clock
+        self.standbys = []
+        self.down = False
+        self.logger = Logger.Logger()
+        brains.commitlisteners.append(self.committed)
+        self.last = clock.seconds()
+        self.heartbeat = task.LoopingCall(self.tick)
+        self.heartbeat.clock = clock
+        self.heartbeat.start(interval, now=False)
+
+    def committed(self, channel, brain, changes):
+        for standby in self.standbys:
+            standby.send('commit', channel, changes)
+
+    def tick(self):
+        now = self.clock.seconds()
+        stalled, self.last = now - self.last, now
+        if self.standbys:
+            timeout = min(s.timeout or self.timeout for s in self.standbys)
+            if stalled >= timeout:
+                self.resign("stalled for %.1fs, a standby takes over after %ss" %
+                            (stalled, timeout))
+                return
+        for standby in self.standbys:
+            standby.send('ping')
+
+    def fenced(self, term):
+        if term > self.term:
+            self.resign("a standby took over with term %d" % term)
+
+    def resign(self, reason):
+        if self.down:
+            return
+        self.down = True
+        self.heartbeat.stop()
+        for standby in list(self.standbys):
+            standby.transport.loseConnection()
+        self.logger.critical("stepping down: %s", reason)
+        self.stepdown(reason)
+
+class ReplicationReceiver(basic.NetstringReceiver):
+    # a snapshot holds a whole namespace
+    MAX_LENGTH = 1 << 30
+
+    def connectionMade(self):
+        self.sendString(message('follow', self.factory.timeout))
+        self.factory.connected(self)
+
+    def stringReceived(self, string):
+        op, argument, payload = parse(string)
+        self.factory.received(op, argument, decoderecords(payload))
+
+class Standby(protocol.ClientFactory):
+    """follows an active instance, calls takeover(replicas, term) once it
+    is gone
+
+    replicas maps every namespace to its entries, term is the one after
+    the followed instance's. Takeover only happens after a first snapshot
+    came in, when no heartbeat arrived for timeout seconds or the
+    connection dropped and could not be made again within timeout
+    seconds; until then connecting is retried every retry seconds. The
+    followed instance is sent the new term, on the open connection or on
+    the next one made after taking over, so if it was only stalled or
+    unreachable it steps down once it hears of it.
+    """
+    protocol = ReplicationReceiver
+
+    def __init__(self, takeover, timeout=5.0, retry=5.0, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.takeover = takeover
+        self.timeout = timeout
+        self.retry = retry
+        self.clock = clock
+        self.replicas = {}
+        self.term = 0
+        self.synced = False
+        self.active = False
+        self.leader = None
+        self.watchdog = None
+        # takeover timer running while the connection is down
+        self.lost = None
+        self.fenced = False
+        self.logger = Logger.Logger()
+
+    def connected(self, leader):
+        if self.active:
+            # something still listens where the followed instance did
+            self.logger.critical("fencing %s with term %d",
+                                 leader.transport.getPeer(), self.term)
+            self.fence(leader)
+            return
+        if self.lost and self.lost.active():
+            self.lost.cancel()
+        self.lost = None
+        self.leader = leader
+        self.logger.info("following %s", leader.transport.getPeer())
+        self.alive()
+
+    def alive(self):
+        if self.watchdog and self.watchdog.active():
+            self.watchdog.reset(self.timeout)
+        else:
+            self.watchdog = self.clock.callLater(self.timeout, self.leaderlost,
+                                                 'no heartbeat for %ss' % self.timeout)
+
+    def received(self, op, channel, changes):
+        self.alive()
+        if op == 'hello':
+            self.term = int(channel)
+        elif op == 'snapshot':
+            self.replicas[channel] = dict(changes)
+            self.synced = True
+        elif op == 'commit':
+            replica = self.replicas.setdefault(channel, {})
+            for name, value in changes:
+                if value is None:
+                    replica.pop(name, None)
+                else:
+                    replica[name] = value
+
+    def clientConnectionLost(self, connector, reason):
+        self.disconnected(reason.getErrorMessage(), connector)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.disconnected(reason.getErrorMessage(), connector)
+
+    def disconnected(self, reason, connector):
+        self.leader = None
+        if self.watchdog and self.watchdog.active():
+            self.watchdog.cancel()
+        if self.active:
+            # keep trying to tell the old instance it was replaced
+            if not self.fenced:
+                self.clock.callLater(self.retry, connector.connect)
+            return
+        if not self.synced:
+            self.logger.info("no active instance to follow (%s), retrying", reason)
+            self.clock.callLater(self.retry, connector.connect)
+            return
+        # a dropped connection alone does not mean the instance is gone
+        if self.lost is None:
+            self.logger.info("lost the active instance (%s), reconnecting for %ss",
+                             reason, self.timeout)
+            self.lost = self.clock.callLater(self.timeout, self.leaderlost, reason)
+        self.clock.callLater(min(self.retry, self.timeout / 5.0), connector.connect)
+
+    def leaderlost(self, reason):
+        if self.active:
+            return
+        if self.watchdog and self.watchdog.active():
+            self.watchdog.cancel()
+        self.active = True
+        self.term += 1
+        self.logger.critical("active instance lost (%s), taking over with term %d",
+                             reason, self.term)
+        if self.leader and self.leader.transport.connected:
+            self.fence(self.leader)
+        self.takeover(self.replicas, self.term)
+
+    def fence(self, leader):
+        leader.sendString(message('fence', self.term))
+        leader.transport.loseConnection()
+        self.fenced = True
@@ -0,0 +1,47 @@
+import sys
+import time
+import argparse
+
+from Leases import parseduration
+from Journal import readevents, analyze, describe
+
+def utilization(stats, span, members=None):
+    members = members or len(stats.members) or 1
+    return stats.busy / (span * members) if span > 0 else 0
+
+def report(path, window, end, targets=None, pools=False):
+    """lines describing every resource and pool of the journal at path,
+    least used first"""
+    stats, first = analyze(readevents(path, end - window), end - window, end, targets)
+    if first is None:
+        return []
+    span = min(window, end - first)
+    keys = [key for key in stats if not pools or key.startswith('pool:')]
+    keys.sort(key=lambda key: (utilization(stats[key], span), key))
+    return [describe(key, stats[key], span) for key in keys]
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description='utilization, hold times and waits of resources and pools, '
+                    'read from the journal in a lockbot dbdir')
+    parser.add_argument('journal', help='the journal file, dbdir/journal')
+    parser.add_argument('--window', default='7d',
+                        help='how far back to look, e.g. 12h or 30d (default 7d)')
+    parser.add_argument('--end', type=float,
+                        help='end of the window as a unix time (default now)')
+    parser.add_argument('--target', action='append',
+                        help='only this resource or pool:<pool>, may be repeated')
+    parser.add_argument('--pools', action='store_true', help='only report pools')
+    options = parser.parse_args(args)
+
+    window = parseduration(options.window)
+    if not window:
+        sys.stderr.write('invalid window "%s"\n' % options.window)
+        return 1
+    end = options.end or time.time()
+    for line in report(options.journal, window, end, options.target, options.pools):
+        sys.stdout.write(line + '\n')
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
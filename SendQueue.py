@@ -0,0 +1,76 @@
+from collections import deque, OrderedDict
+
+# Room left for the ":nick!user@host PRIVMSG #target :" prefix the server
+# adds when relaying, out of the 512 byte IRC line limit.
+MAXLINELENGTH = 400
+
+SEPARATOR = ' | '
+
+class SendQueue(object):
+    """outgoing message scheduler
+
+    Lines are queued per target, urgent ones (lock replies) ahead of bulk
+    ones (listings). A token bucket refilled at rate lines per second, and
+    holding at most burst tokens, paces the sends to stay under the
+    server's flood limits. Consecutive short lines queued for the same
+    target are packed into one IRC line.
+    """
+    def __init__(self, send, clock, rate=0.5, burst=5, maxlen=MAXLINELENGTH):
+        if rate <= 0:
+            raise ValueError('line rate must be above 0, not %s' % rate)
+        if burst < 1:
+            raise ValueError('line burst must be at least 1, not %s' % burst)
+        self.send = send
+        self.clock = clock
+        self.rate = rate
+        self.burst = burst
+        self.maxlen = maxlen
+        self.tokens = burst
+        self.stamp = clock.seconds()
+        self.urgent = OrderedDict()
+        self.bulk = OrderedDict()
+        self.pending = None
+
+    def put(self, messages, urgent=False):
+        queues = self.urgent if urgent else self.bulk
+        for target, line in messages:
+            queues.setdefault(target, deque()).append(line)
+        if self.pending is None:
+            self.drain()
+
+    def __len__(self):
+        return sum(len(q) for queues in (self.urgent, self.bulk)
+                   for q in queues.values())
+
+    def refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def pack(self, queue):
+        line = queue.popleft()
+        while queue and len(line) + len(SEPARATOR) + len(queue[0].strip()) <= self.maxlen:
+            line = line.rstrip() + SEPARATOR + queue.popleft().strip()
+        return line
+
+    def drain(self):
+        self.pending = None
+        self.refill()
+        while self.tokens >= 1:
+            queues = self.urgent or self.bulk
+            if not queues:
+                return
+            # round robin between targets
+            target, queue = queues.popitem(last=False)
+            self.send(target, self.pack(queue))
+            self.tokens -= 1
+            if queue:
+                queues[target] = queue
+        if self.pending is None and (self.urgent or self.bulk):
+            self.pending = self.clock.callLater((1 - self.tokens) / self.rate,
+                                                self.drain)
+
+    def stop(self):
+        if self.pending is not None and self.pending.active():
+            self.pending.cancel()
+        self.pending = None
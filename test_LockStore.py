@@ -0,0 +1,157 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from twisted.internet.task import Clock
+
+import LockStore
+from LockStore import LogStore, frame, encoderecords
+
+class LogStoreRecoveryTest(unittest.TestCase):
+    """what a LogStore holds after crashes at various points"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='lockbot-test-')
+        self.path = os.path.join(self.dir, 'locks')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open(self, **options):
+        return LogStore(self.path, **options)
+
+    def crash(self, store):
+        # drop the store without the compaction of a clean close
+        store.log.close()
+        store.lockfile.close()
+
+    def populate(self):
+        store = self.open()
+        store.commit([('a', ''), ('b', '')])
+        store.commit([('a', 'al')])
+        store.commit([('b', 'bo')])
+        self.crash(store)
+        return os.path.getsize(store.logpath)
+
+    def reopen(self):
+        store = self.open()
+        table = dict(store.load())
+        store.close()
+        return table
+
+    def test_replays_log_after_crash(self):
+        self.populate()
+        self.assertEqual(self.reopen(), {'a': 'al', 'b': 'bo'})
+
+    def test_torn_frame_is_dropped(self):
+        size = self.populate()
+        with open(self.path + '.log', 'ab') as f:
+            f.write(frame(encoderecords([('a', '')]))[:-5])
+        store = self.open()
+        self.assertEqual(dict(store.load()), {'a': 'al', 'b': 'bo'})
+        # cut back to the last intact frame, so new commits follow it
+        self.assertEqual(os.path.getsize(store.logpath), size)
+        store.commit([('c', '')])
+        self.crash(store)
+        self.assertEqual(self.reopen(), {'a': 'al', 'b': 'bo', 'c': ''})
+
+    def test_torn_header_is_dropped(self):
+        size = self.populate()
+        with open(self.path + '.log', 'ab') as f:
+            f.write('0badc0')
+        store = self.open()
+        self.assertEqual(os.path.getsize(store.logpath), size)
+        store.close()
+
+    def test_bad_crc_stops_replay(self):
+        self.populate()
+        with open(self.path + '.log', 'rb') as f:
+            data = f.read()
+        # flip a byte in the payload of the last frame
+        last = data.rindex('bo')
+        with open(self.path + '.log', 'wb') as f:
+            f.write(data[:last] + 'xo' + data[last + 2:])
+        self.assertEqual(self.reopen(), {'a': 'al', 'b': ''})
+
+    def test_crash_before_snapshot_rename(self):
+        self.populate()
+        # a snapshot was being written when the process died
+        with open(self.path + '.snap.tmp', 'wb') as f:
+            f.write(LockStore.SNAPSHOT_MAGIC + 'garbage')
+        self.assertEqual(self.reopen(), {'a': 'al', 'b': 'bo'})
+
+    def test_crash_between_snapshot_and_truncate(self):
+        store = self.open()
+        store.commit([('a', ''), ('b', '')])
+        store.commit([('a', 'al')])
+        # the snapshot is in place but the log was not truncated yet
+        store.snapshot()
+        self.crash(store)
+        self.assertEqual(self.reopen(), {'a': 'al', 'b': ''})
+
+    def test_log_after_compaction(self):
+        store = self.open(compactbytes=1)
+        store.commit([('a', ''), ('b', '')])
+        self.assertEqual(os.path.getsize(store.logpath), 0)
+        store.commit([('a', 'al')])
+        store.commit([('b', None)])
+        self.crash(store)
+        self.assertEqual(self.reopen(), {'a': 'al'})
+
+    def test_corrupt_snapshot_is_refused(self):
+        with open(self.path + '.snap', 'wb') as f:
+            f.write('not a snapshot\n')
+        self.assertRaises(IOError, self.open)
+
+    def test_torn_snapshot_is_refused(self):
+        store = self.open()
+        store.commit([('a', 'al'), ('b', '')])
+        store.close()
+        with open(self.path + '.snap', 'rb') as f:
+            data = f.read()
+        with open(self.path + '.snap', 'wb') as f:
+            f.write(data[:-3] + 'x' + data[-2:])
+        self.assertRaises(IOError, self.open)
+        with open(self.path + '.snap', 'wb') as f:
+            f.write(data[:-5])
+        self.assertRaises(IOError, self.open)
+
+    def test_second_process_is_refused(self):
+        store = self.open()
+        self.assertRaises(IOError, self.open)
+        store.close()
+
+class FsyncPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='lockbot-test-')
+        self.path = os.path.join(self.dir, 'locks')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_interval_syncs_the_last_commit(self):
+        clock = Clock()
+        store = LogStore(self.path, fsync=10, clock=clock)
+        store.commit([('a', '')])
+        self.assertEqual(store.synced, 0)
+        clock.advance(1)
+        store.commit([('a', 'al')])
+        store.commit([('a', 'bo')])
+        # nothing else is committed, the timer syncs the burst
+        self.assertEqual(store.synced, 0)
+        clock.advance(9)
+        self.assertEqual(store.synced, 10)
+        self.assertEqual(clock.getDelayedCalls(), [])
+        store.close()
+
+    def test_policies(self):
+        self.assertEqual(LockStore.fsyncpolicy('always'), 0)
+        self.assertEqual(LockStore.fsyncpolicy('never'), None)
+        self.assertEqual(LockStore.fsyncpolicy('0.5'), 0.5)
+        self.assertRaises(ValueError, LockStore.fsyncpolicy, '-1')
+        self.assertRaises(ValueError, LockStore.fsyncpolicy, 'sometimes')
+
+if __name__ == '__main__':
+    unittest.main()